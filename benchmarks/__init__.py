@@ -0,0 +1 @@
+"""Benchmarks of book-worm against an in-process fake of Google Sheets"""
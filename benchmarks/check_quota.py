@@ -0,0 +1,112 @@
+"""
+Checks of the rate limiting and retries in quota.py against a fake.
+
+Each check sends one request through a QuotaClient whose HTTP session is
+a ScheduledSession, which answers with rate limit (429) and server errors
+on a schedule. It then compares the requests sent, the retries and
+backoff counted in a QuotaStats and the waits asked of sleep with what
+the schedule should cause. The token bucket is checked with a fake clock.
+Nothing actually waits.
+
+    python -m benchmarks.check_quota
+"""
+import os
+import sys
+
+from gspread.exceptions import APIError
+
+from benchmarks.fake_sheets import ScheduledSession
+from quota import QuotaStats, TokenBucket
+from storage.sheets import QuotaClient
+
+URL = 'https://sheets.googleapis.com/v4/spreadsheets/fake/values/A1'
+
+
+def send(method, schedule, retry_after=None, retries=5):
+    """
+    Send one request through a QuotaClient answering with schedule, and
+    return (response or APIError, requests sent, stats, waits asked for)
+    """
+    session = ScheduledSession(schedule, retry_after)
+    client = QuotaClient(None, session=session)
+    waits = []
+    client.sleep = waits.append
+    client.stats = QuotaStats()
+    os.environ['BOOKWORM_MAX_RETRIES'] = str(retries)
+    try:
+        result = client.request(method, URL)
+    except APIError as error:
+        result = error
+    return result, len(session.requests), client.stats, waits
+
+
+def check_retries_rate_limits():
+    result, sent, stats, waits = send('get', [429, 429])
+    return (not isinstance(result, APIError) and sent == 3
+            and stats.retries == 2 and len(waits) == 2
+            and stats.backoff == sum(waits)
+            and waits[0] <= 1 and waits[1] <= 2)
+
+
+def check_honours_retry_after():
+    _, sent, stats, waits = send('get', [429], retry_after=7)
+    return sent == 2 and waits == [7.0] and stats.backoff == 7.0
+
+
+def check_gives_up_after_max_retries():
+    result, sent, stats, waits = send('get', [429] * 10, retries=3)
+    return (isinstance(result, APIError)
+            and result.response.status_code == 429
+            and sent == 4 and stats.retries == 3 and len(waits) == 3)
+
+
+def check_does_not_resend_writes_that_may_have_applied():
+    result, sent, stats, waits = send('post', [500])
+    return (isinstance(result, APIError) and sent == 1
+            and stats.retries == 0 and not waits)
+
+
+def check_retries_writes_that_were_not_applied():
+    result, sent, stats, _ = send('post', [503, 429])
+    return not isinstance(result, APIError) and sent == 3 \
+        and stats.retries == 2
+
+
+def check_limiter_counts_its_wait():
+    now = [0.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    bucket = TokenBucket(60, capacity=2, clock=lambda: now[0], sleep=sleep)
+    waits = [bucket.acquire() for _ in range(4)]
+    return waits == [0, 0, 1.0, 1.0] and bucket.waited == 2.0
+
+
+CHECKS = [check_retries_rate_limits, check_honours_retry_after,
+          check_gives_up_after_max_retries,
+          check_does_not_resend_writes_that_may_have_applied,
+          check_retries_writes_that_were_not_applied,
+          check_limiter_counts_its_wait]
+
+
+def main():
+    """
+    Run every check, print whether it passed and exit with 1 if any failed
+    """
+    retries = os.environ.get('BOOKWORM_MAX_RETRIES')
+    failed = 0
+    for check in CHECKS:
+        passed = check()
+        failed += not passed
+        print(f"{'ok  ' if passed else 'FAIL'} "
+              f"{check.__name__[6:].replace('_', ' ')}")
+    if retries is None:
+        os.environ.pop('BOOKWORM_MAX_RETRIES', None)
+    else:
+        os.environ['BOOKWORM_MAX_RETRIES'] = retries
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+"""
+In-process stand-in for a gspread spreadsheet and its worksheets.
+
+Implements the calls the Google Sheets storage backend makes, keeping the
+cells in memory. Every call sleeps for a configurable latency, as a real
+round trip would, and is counted in CallStats together with the size of
+its request and response encoded as JSON.
+"""
+import json
+import threading
+import time
+from collections import Counter
+
+from gspread.exceptions import APIError
+from gspread.utils import a1_range_to_grid_range
+
+
+def _size(payload):
+    """
+    Return the size in bytes of a payload sent as JSON
+    """
+    return len(json.dumps(payload, default=str).encode('utf-8'))
+
+
+class FakeResponse:
+    """
+    The parts of an HTTP response that gspread and its APIError read
+    """
+
+    def __init__(self, status_code, message, headers=None):
+        self.status_code = status_code
+        self.text = message
+        self.headers = headers or {}
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        if self.ok:
+            return {}
+        return {'error': {'code': self.status_code, 'message': self.text}}
+
+
+class ScheduledSession:
+    """
+    Stands in for the HTTP session of a gspread client, answering each
+    request with the next status of a schedule such as [429, 429, 200],
+    and 200 once the schedule has run out. Rate limited answers carry a
+    Retry-After header of retry_after seconds if it is given. The method
+    and URL of every request are kept in requests.
+    """
+
+    def __init__(self, schedule, retry_after=None):
+        self.schedule = list(schedule)
+        self.retry_after = retry_after
+        self.requests = []
+
+    def _respond(self, method, url):
+        self.requests.append((method, url))
+        status = self.schedule.pop(0) if self.schedule else 200
+        headers = {}
+        if status == 429 and self.retry_after is not None:
+            headers['Retry-After'] = str(self.retry_after)
+        return FakeResponse(status, 'Quota exceeded' if status == 429
+                            else 'OK', headers)
+
+    def get(self, url, **kwargs):
+        return self._respond('GET', url)
+
+    def post(self, url, **kwargs):
+        return self._respond('POST', url)
+
+    def put(self, url, **kwargs):
+        return self._respond('PUT', url)
+
+
+def _value(cell):
+    """
+    Return the formatted value of a CellData dict
+    """
+    value = cell.get('userEnteredValue', {})
+    if 'numberValue' in value:
+        number = value['numberValue']
+        return str(int(number)) if number == int(number) else str(number)
+    return str(value.get('stringValue', ''))
+
+
+class CallStats:
+    """
+    Number of API calls and bytes sent and received, by call name
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.bytes = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, name, request, response):
+        """
+        Count one call with its request and response payloads
+        """
+        with self.lock:
+            self.calls[name] += 1
+            self.bytes[name] += _size(request) + _size(response)
+
+    def reset(self):
+        """
+        Forget every call counted so far
+        """
+        with self.lock:
+            self.calls.clear()
+            self.bytes.clear()
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    @property
+    def total_bytes(self):
+        return sum(self.bytes.values())
+
+
+class FakeWorksheet:
+    """
+    A worksheet whose cells are a list of rows of strings
+    """
+
+    def __init__(self, spreadsheet, sheet_id, title, rows=None, cols=20):
+        self.spreadsheet = spreadsheet
+        self.id = sheet_id
+        self.title = title
+        self.rows = rows if rows is not None else []
+        self.col_count = cols
+        self.grid_rows = max(len(self.rows), 1)
+
+    @property
+    def row_count(self):
+        return self.grid_rows
+
+    def _call(self, name, request, response):
+        return self.spreadsheet.call(name, request, response)
+
+    def _grid(self, range_name):
+        """
+        Return the rows in an A1 range, without trailing empty rows
+        """
+        grid = a1_range_to_grid_range(range_name)
+        start = grid.get('startRowIndex', 0)
+        stop = grid.get('endRowIndex', len(self.rows))
+        first = grid.get('startColumnIndex', 0)
+        last = grid.get('endColumnIndex', self.col_count)
+        values = [row[first:last] for row in self.rows[start:stop]]
+        while values and not any(values[-1]):
+            values.pop()
+        return values
+
+    def get_all_values(self):
+        return self._call('get_all_values', None,
+                          [list(row) for row in self.rows])
+
+    def get(self, range_name):
+        return self._call('get', range_name, self._grid(range_name))
+
+    def append_row(self, row):
+        self.append_rows([row])
+
+    def append_rows(self, rows):
+        rows = [[str(value) for value in row] for row in rows]
+        self._call('append_rows', rows, None)
+        self.rows.extend(rows)
+        self.grid_rows = max(self.grid_rows, len(self.rows))
+
+    def delete_rows(self, start, end=None):
+        end = end or start
+        self._call('delete_rows', [start, end], None)
+        del self.rows[start - 1:end]
+        self.grid_rows -= end - start + 1
+
+    def copy_to(self, spreadsheet_id):
+        target = self.spreadsheet.client.by_id(spreadsheet_id)
+        copy = target.add_worksheet(f'Copy of {self.title}',
+                                    [list(row) for row in self.rows],
+                                    self.col_count)
+        properties = {'sheetId': copy.id, 'title': copy.title}
+        return self._call('copy_to', spreadsheet_id, properties)
+
+
+class FakeClient:
+    """
+    Opens FakeSpreadsheets by title, as gspread.Client.open does
+    """
+
+    def __init__(self):
+        self.spreadsheets = {}
+
+    def open(self, title):
+        return self.spreadsheets[title]
+
+    def by_id(self, spreadsheet_id):
+        for spreadsheet in self.spreadsheets.values():
+            if spreadsheet.id == spreadsheet_id:
+                return spreadsheet
+        raise KeyError(spreadsheet_id)
+
+
+class FakeSpreadsheet:
+    """
+    A spreadsheet holding FakeWorksheets, with a 'users' worksheet to
+    start with. latency is the time in seconds every call takes. Every
+    spreadsheet opened through the same client shares its stats.
+    """
+
+    def __init__(self, latency=0.0, title='book_worm', client=None,
+                 stats=None):
+        self.latency = latency
+        self.stats = stats or CallStats()
+        self.client = client or FakeClient()
+        self.client.spreadsheets[title] = self
+        self.id = f'fake-{title}'
+        self.title = title
+        self.sheets = {}
+        self.next_id = 1
+        self.add_worksheet('users', rows=[])
+
+    def call(self, name, request, response):
+        """
+        Count a call, wait as long as a round trip would and return its
+        response
+        """
+        self.stats.record(name, request, response)
+        if self.latency:
+            time.sleep(self.latency)
+        return response
+
+    def add_worksheet(self, title, rows=None, cols=20, sheet_id=None):
+        """
+        Add a worksheet directly, without counting it as a call
+        """
+        sheet_id = sheet_id or self.next_id
+        self.next_id = max(self.next_id, sheet_id) + 1
+        worksheet = FakeWorksheet(self, sheet_id, title, rows, cols)
+        self.sheets[title] = worksheet
+        return worksheet
+
+    def _by_id(self, sheet_id):
+        for worksheet in self.sheets.values():
+            if worksheet.id == sheet_id:
+                return worksheet
+        raise KeyError(sheet_id)
+
+    def worksheets(self):
+        return self.call('worksheets', None, list(self.sheets.values()))
+
+    def worksheet(self, title):
+        return self.call('worksheet', title, self.sheets[title])
+
+    def values_get(self, range_name, params=None):
+        title, _, cells = range_name.partition('!')
+        values = self.sheets[title.strip("'")]._grid(cells)
+        return self.call('values_get', range_name, {'values': values})
+
+    def values_batch_get(self, ranges, params=None):
+        value_ranges = []
+        for range_name in ranges:
+            title, _, cells = range_name.partition('!')
+            value_ranges.append({
+                'range': range_name,
+                'values': self.sheets[title.strip("'")]._grid(cells)})
+        return self.call('values_batch_get', ranges,
+                         {'valueRanges': value_ranges})
+
+    def values_update(self, range_name, params=None, body=None):
+        title, _, cells = range_name.partition('!')
+        worksheet = self.sheets[title.strip("'")]
+        grid = a1_range_to_grid_range(cells)
+        for offset, values in enumerate(body['values']):
+            self._write(worksheet, grid['startRowIndex'] + offset,
+                        grid.get('startColumnIndex', 0), values)
+        return self.call('values_update', body, {})
+
+    def fetch_sheet_metadata(self, params=None):
+        title = (params or {}).get('ranges', '').strip("'")
+        sheets = [self.sheets[title]] if title else self.sheets.values()
+        metadata = {'sheets': [{'properties': {
+            'sheetId': worksheet.id,
+            'title': worksheet.title,
+            'gridProperties': {'rowCount': worksheet.row_count,
+                               'columnCount': worksheet.col_count}
+        }} for worksheet in sheets]}
+        return self.call('fetch_sheet_metadata', params, metadata)
+
+    @staticmethod
+    def _write(worksheet, row, col, values):
+        """
+        Write values into a worksheet starting at a 0-based cell
+        """
+        while len(worksheet.rows) <= row:
+            worksheet.rows.append([])
+        cells = worksheet.rows[row]
+        cells.extend([''] * (col + len(values) - len(cells)))
+        cells[col:col + len(values)] = [str(value) for value in values]
+        worksheet.grid_rows = max(worksheet.grid_rows, len(worksheet.rows))
+
+    def batch_update(self, body):
+        replies = []
+        for request in body['requests']:
+            (kind, detail), = request.items()
+            reply = {}
+            if kind == 'addSheet':
+                properties = detail['properties']
+                if properties['title'] in self.sheets:
+                    raise APIError(FakeResponse(
+                        400, f"A sheet with the name \"{properties['title']}"
+                             "\" already exists"))
+                self.add_worksheet(properties['title'],
+                                   sheet_id=properties.get('sheetId'))
+                reply = {'addSheet': {'properties': properties}}
+            elif kind == 'updateCells':
+                worksheet = self._by_id(detail['start']['sheetId'])
+                for offset, row in enumerate(detail['rows']):
+                    self._write(worksheet,
+                                detail['start']['rowIndex'] + offset,
+                                detail['start'].get('columnIndex', 0),
+                                [_value(cell) for cell in row['values']])
+            elif kind == 'appendCells':
+                worksheet = self._by_id(detail['sheetId'])
+                worksheet.rows.extend(
+                    [[_value(cell) for cell in row['values']]
+                     for row in detail['rows']])
+                worksheet.grid_rows = max(worksheet.grid_rows,
+                                          len(worksheet.rows))
+            elif kind == 'appendDimension':
+                worksheet = self._by_id(detail['sheetId'])
+                if detail['dimension'] == 'COLUMNS':
+                    worksheet.col_count += detail['length']
+                else:
+                    worksheet.grid_rows += detail['length']
+            elif kind == 'updateSheetProperties':
+                properties = detail['properties']
+                worksheet = self._by_id(properties['sheetId'])
+                del self.sheets[worksheet.title]
+                worksheet.title = properties['title']
+                self.sheets[worksheet.title] = worksheet
+            elif kind == 'deleteSheet':
+                del self.sheets[self._by_id(detail['sheetId']).title]
+            elif kind == 'deleteDimension':
+                grid = detail['range']
+                worksheet = self._by_id(grid['sheetId'])
+                del worksheet.rows[grid['startIndex']:grid['endIndex']]
+                worksheet.grid_rows -= grid['endIndex'] - grid['startIndex']
+            else:
+                raise NotImplementedError(kind)
+            replies.append(reply)
+        return self.call('batch_update', body, {'replies': replies})
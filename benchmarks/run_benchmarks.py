@@ -0,0 +1,176 @@
+"""
+Headless benchmarks of the menu actions in run.py.
+
+Each action is driven through the real menu function with its input()
+and prompt() answers scripted, against a library in an in-process fake of
+the Google Sheets spreadsheet. Every call to the fake waits for the
+configured latency, so the wall time reflects how many round trips an
+action makes as well as the work it does locally.
+
+Every action is run twice on each library size: cold, on a library that
+has not been loaded yet as straight after logging in, and warm, once it
+has. For each run the wall time, the number of API calls and the bytes
+sent and received are reported.
+
+    python -m benchmarks.run_benchmarks --sizes 100 1000 100000 --latency 0.1
+"""
+import argparse
+import contextlib
+import io
+import time
+import types
+
+from tabulate import tabulate
+
+import run
+from benchmarks.fake_sheets import FakeSpreadsheet
+from library import Library
+from storage import row_checksum
+from storage.sheets import COLUMNS, SheetsStorage
+
+USERNAME = 'benchmark'
+
+GENRES = ['Fantasy', 'Science Fiction', 'Mystery', 'Romance', 'History',
+          'Poetry', 'Horror', 'Biography']
+
+
+def title(number):
+    """
+    Return the title of the generated book number
+    """
+    return f'Book {number:07d}'
+
+
+def make_books(count):
+    """
+    Generate count books spread over 997 authors, 120 years and the genres
+    """
+    return [[title(number),
+             f'Author {number % 997}',
+             str(1900 + number % 120),
+             GENRES[number % len(GENRES)],
+             ''] for number in range(count)]
+
+
+def actions(count):
+    """
+    Return each action as (name, function, answers), where answers(run)
+    gives the answers for the cold (0) or warm (1) run. Removes and
+    updates pick a different book on each run.
+    """
+    return [
+        ('add_book', run.add_book, lambda attempt: [
+            f'New Book {attempt}', 'New Author', '2001', 'Fantasy', '',
+            'n']),
+        ('remove_book', run.remove_book, lambda attempt: [
+            title(count // 4 + attempt), 'n']),
+        ('update_book', run.update_book, lambda attempt: [
+            title(count // 2 + attempt), '', '', '1999', '']),
+        ('search_books_by_title',
+         lambda: run.search_books_by_title(title(count // 3)[:-1]),
+         lambda attempt: ['q']),
+        ('search_books_by_author',
+         lambda: run.search_books_by_author('Author 7'),
+         lambda attempt: ['q']),
+        ('search_books_by_genre',
+         lambda: run.search_books_by_genre('Mystery'),
+         lambda attempt: ['q']),
+        ('search_books_by_query',
+         lambda: run.search_books_by_query(
+             'author:"Author 7" genre:mystery year:1950..1960'),
+         lambda attempt: ['q']),
+        ('show_statistics', run.show_statistics, lambda attempt: ['q']),
+        ('display_books', run.display_books, lambda attempt: [
+            'Next page', 'Back']),
+    ]
+
+
+class Script:
+    """
+    Answers input() and prompt() calls in turn from a list of answers
+    """
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+
+    def _next(self, question):
+        if not self.answers:
+            raise RuntimeError(f"no answer scripted for {question!r}")
+        return self.answers.pop(0)
+
+    def input(self, message=''):
+        return self._next(message)
+
+    def prompt(self, questions, theme=None):
+        return {question.name: self._next(question.message)
+                for question in questions}
+
+
+def measure(spreadsheet, action, answers):
+    """
+    Run an action with scripted answers and return its wall time and the
+    calls and bytes it cost. Prefetches still running when the action
+    returns count towards its calls but not its wall time.
+    """
+    script = Script(answers)
+    run.input = script.input
+    run.prompt = script.prompt
+    spreadsheet.stats.reset()
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        action()
+        wall = time.perf_counter() - start
+        if run.SESSION.prefetcher is not None:
+            run.SESSION.prefetcher.submit(lambda: None).result()
+    return wall, spreadsheet.stats.total_calls, spreadsheet.stats.total_bytes
+
+
+def benchmark(count, latency):
+    """
+    Run every action cold and warm on a library of count books and return
+    a result row for each
+    """
+    spreadsheet = FakeSpreadsheet(latency)
+    spreadsheet.add_worksheet(USERNAME, rows=[list(COLUMNS)] + [
+        book + [row_checksum(book)] for book in make_books(count)])
+    store = SheetsStorage(spreadsheet).open_library(USERNAME)
+
+    results = []
+    for name, action, answers in actions(count):
+        run.SESSION.library = Library(store)
+        cold = measure(spreadsheet, action, answers(0))
+        warm = measure(spreadsheet, action, answers(1))
+        results.append([name, count, *cold, *warm])
+    return results
+
+
+def main():
+    """
+    Parse the command line, run the benchmarks and print the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000],
+                        help="library sizes in books (default 100 1000 "
+                             "10000, up to 1000000)")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="seconds each API call takes (default 0.05)")
+    args = parser.parse_args()
+
+    # the menus pause after messages for the user to read them
+    sleep, run.time = run.time, types.SimpleNamespace(sleep=lambda _: None)
+    try:
+        results = []
+        for count in args.sizes:
+            results.extend(benchmark(count, args.latency))
+    finally:
+        run.time = sleep
+        del run.input, run.prompt
+    print(tabulate(results,
+                   headers=['Action', 'Books', 'Cold s', 'Calls', 'Bytes',
+                            'Warm s', 'Calls', 'Bytes'],
+                   floatfmt='.3f'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Look up book details on the Google Books API"""
+import requests
+
+import metrics
+from isbn_cache import get_cache, normalise_isbn
+from quota import call_with_retry, RETRY_STATUSES, BOOKS_REQUESTS
+
+BOOKS_API_URL = "https://www.googleapis.com/books/v1/volumes"
+
+# shared session so repeated lookups reuse their HTTP connections
+SESSION = requests.Session()
+
+
+def _get(isbn):
+    """
+    Send the volumes query for an ISBN, raising HTTPError for responses
+    that are worth retrying
+    """
+    response = metrics.call(
+        'books', 'GET volumes',
+        lambda: SESSION.get(BOOKS_API_URL, params={'q': f'isbn:{isbn}'},
+                            timeout=10))
+    if response.status_code in RETRY_STATUSES:
+        response.raise_for_status()
+    return response
+
+
+def _should_retry(error):
+    """
+    Retry lost connections, timeouts, rate limits and server errors
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response.status_code in RETRY_STATUSES
+    return isinstance(error, (requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout))
+
+
+def fetch_isbn(isbn):
+    """
+    Ask Google Books for an ISBN and return the book as
+    [title, authors, year, genres], or None if it has no book with that
+    ISBN. Network and HTTP errors are raised as requests exceptions.
+    """
+    response = call_with_retry(lambda: _get(isbn), _should_retry,
+                               BOOKS_REQUESTS)
+    response.raise_for_status()
+
+    items = response.json().get("items")
+    if not items:
+        return None
+    book_data = items[0]["volumeInfo"]
+
+    # Extract book information from the API response
+    title = book_data.get("title")
+    if not title:
+        return None
+    authors = ", ".join(book_data.get("authors", ["Unknown"]))
+    year = book_data.get("publishedDate", "Unknown")[:4]
+    genres = ", ".join(book_data.get("categories", ["Unknown"]))
+    return [title, authors, year, genres]
+
+
+def lookup_isbn(isbn):
+    """
+    Look up an ISBN, answering from the ISBN cache when it has a fresh
+    entry and falling back to an expired one if Google Books cannot be
+    reached. Returns the book as [title, authors, year, genres], or None
+    if there is no book with that ISBN.
+    """
+    isbn = normalise_isbn(isbn)
+    cache = get_cache()
+    cached = cache.get(isbn)
+    if cached and cached[1]:
+        return cached[0]
+
+    try:
+        book = fetch_isbn(isbn)
+    except requests.exceptions.RequestException:
+        if cached:
+            return cached[0]
+        raise
+    cache.put(isbn, book)
+    return book
@@ -1,5 +1,23 @@
 const Pty = require('node-pty');
 const fs = require('fs');
+const net = require('net');
+const { spawn } = require('child_process');
+
+// With BOOKWORM_SERVER set, one long-lived `python3 server.py` serves every
+// connection and shares the Google client and caches between them, instead
+// of each connection spawning its own `python3 run.py`
+const SERVER_PORT = parseInt(process.env.BOOKWORM_SERVER_PORT || '8765');
+
+if (process.env.BOOKWORM_SERVER) {
+    const server = spawn('python3', ['server.py'], {
+        cwd: process.env.PWD,
+        env: process.env,
+        stdio: 'inherit'
+    });
+    server.on('exit', function (code) {
+        console.log("Book-worm server exited with code " + code);
+    });
+}
 
 exports.install = function () {
 
@@ -15,6 +33,27 @@ function socket() {
 
     this.on('open', function (client) {
 
+        if (process.env.BOOKWORM_SERVER) {
+            // Connect to the session server
+            client.session = net.connect(SERVER_PORT, '127.0.0.1');
+            client.session.setEncoding('utf8');
+
+            client.session.on('data', function (data) {
+                client.send(data);
+            });
+
+            client.session.on('error', function (err) {
+                console.log("Session server error: " + err.message);
+            });
+
+            client.session.on('close', function () {
+                client.session = null;
+                client.close();
+                console.log("Session closed");
+            });
+            return;
+        }
+
         // Spawn terminal
         client.tty = Pty.spawn('python3', ['run.py'], {
             name: 'xterm-color',
@@ -37,6 +76,11 @@ function socket() {
     });
 
     this.on('close', function (client) {
+        if (client.session) {
+            client.session.destroy();
+            client.session = null;
+            console.log("Session closed and terminal unloaded");
+        }
         if (client.tty) {
             client.tty.kill(9);
             client.tty = null;
@@ -46,6 +90,7 @@ function socket() {
 
     this.on('message', function (client, msg) {
         client.tty && client.tty.write(msg);
+        client.session && client.session.write(msg);
     });
 }
 
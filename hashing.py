@@ -0,0 +1,148 @@
+"""
+Argon2 password hashing with tunable parameters.
+
+The time cost, memory cost (in KiB) and parallelism are read from
+argon2.json, written by the calibration command below, and can be
+overridden with the BOOKWORM_ARGON2_TIME_COST, BOOKWORM_ARGON2_MEMORY_COST
+and BOOKWORM_ARGON2_PARALLELISM environment variables. Anything not set
+falls back to the argon2-cffi defaults.
+
+Run "python hashing.py --target-ms 250 --max-memory-mib 32" to benchmark
+this host and write the parameters that verify a password in about the
+target time without using more than the given memory.
+"""
+import argparse
+import json
+import os
+import time
+
+import argon2
+
+import metrics
+
+# file the calibration command writes its parameters to
+CONFIG_FILE = 'argon2.json'
+
+# smallest memory cost calibration will go down to, in KiB
+MIN_MEMORY_COST = 8 * 1024
+
+PARAMETERS = {
+    'time_cost': 'BOOKWORM_ARGON2_TIME_COST',
+    'memory_cost': 'BOOKWORM_ARGON2_MEMORY_COST',
+    'parallelism': 'BOOKWORM_ARGON2_PARALLELISM',
+}
+
+
+def load_parameters(config_file=CONFIG_FILE):
+    """
+    Return the configured Argon2 parameters as keyword arguments for
+    argon2.PasswordHasher
+    """
+    parameters = {}
+    try:
+        with open(config_file, encoding='utf-8') as file:
+            saved = json.load(file)
+        parameters.update({name: int(saved[name])
+                           for name in PARAMETERS if name in saved})
+    except FileNotFoundError:
+        pass
+    for name, variable in PARAMETERS.items():
+        if os.environ.get(variable):
+            parameters[name] = int(os.environ[variable])
+    return parameters
+
+
+class MeasuredPasswordHasher(argon2.PasswordHasher):
+    """
+    A PasswordHasher that records how long hashing and verifying take
+    """
+
+    def hash(self, password):
+        return metrics.call('argon2', 'hash', lambda: argon2.PasswordHasher
+                            .hash(self, password))
+
+    def verify(self, hash, password):  # pylint: disable=redefined-builtin
+        return metrics.call('argon2', 'verify', lambda: argon2.PasswordHasher
+                            .verify(self, hash, password))
+
+
+def make_password_hasher():
+    """
+    Return a PasswordHasher using the configured parameters, measured if
+    metrics are enabled
+    """
+    if metrics.ENABLED:
+        return MeasuredPasswordHasher(**load_parameters())
+    return argon2.PasswordHasher(**load_parameters())
+
+
+def time_verify(time_cost, memory_cost, parallelism, rounds=3):
+    """
+    Return the fastest time in milliseconds taken to verify a password
+    hashed with these parameters
+    """
+    hasher = argon2.PasswordHasher(time_cost=time_cost,
+                                   memory_cost=memory_cost,
+                                   parallelism=parallelism)
+    password_hash = hasher.hash('calibration password')
+    fastest = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        hasher.verify(password_hash, 'calibration password')
+        elapsed = (time.perf_counter() - start) * 1000
+        fastest = elapsed if fastest is None else min(fastest, elapsed)
+    return fastest
+
+
+def calibrate(target_ms, max_memory_cost, parallelism=1):
+    """
+    Pick parameters that verify a password in about target_ms on this
+    host. The memory cost is the largest power-of-two fraction of
+    max_memory_cost that is fast enough, then the time cost is raised
+    until verifying takes at least target_ms.
+    """
+    memory_cost = max_memory_cost
+    time_cost = 1
+    elapsed = time_verify(time_cost, memory_cost, parallelism)
+    while elapsed > target_ms and memory_cost // 2 >= MIN_MEMORY_COST:
+        memory_cost //= 2
+        elapsed = time_verify(time_cost, memory_cost, parallelism)
+    while elapsed < target_ms:
+        next_elapsed = time_verify(time_cost + 1, memory_cost, parallelism)
+        # stop below the target rather than overshooting it by more
+        if next_elapsed - target_ms > target_ms - elapsed:
+            break
+        time_cost += 1
+        elapsed = next_elapsed
+    return {'time_cost': time_cost, 'memory_cost': memory_cost,
+            'parallelism': parallelism}, elapsed
+
+
+def main():
+    """
+    Calibrate Argon2 for this host and save the parameters
+    """
+    parser = argparse.ArgumentParser(
+        description="Pick Argon2 parameters for a target verify time.")
+    parser.add_argument('--target-ms', type=float, default=250,
+                        help="target time to verify a password")
+    parser.add_argument('--max-memory-mib', type=int, default=64,
+                        help="most memory a single hash may use")
+    parser.add_argument('--parallelism', type=int, default=1)
+    parser.add_argument('--output', default=CONFIG_FILE)
+    args = parser.parse_args()
+
+    parameters, elapsed = calibrate(
+        args.target_ms, args.max_memory_mib * 1024, args.parallelism)
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(parameters, file, indent=4)
+    print(f"time_cost={parameters['time_cost']} "
+          f"memory_cost={parameters['memory_cost']} KiB "
+          f"parallelism={parameters['parallelism']}: "
+          f"{elapsed:.0f} ms per verify")
+    print(f"Saved to {args.output}. Existing hashes are upgraded the next "
+          "time each user logs in.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Persistent cache of Google Books lookups keyed by ISBN"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import isbnlib
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS isbn_cache (
+    isbn TEXT PRIMARY KEY,
+    book TEXT,
+    fetched REAL NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS isbn_cache_used ON isbn_cache (used);
+"""
+
+
+def normalise_isbn(isbn):
+    """
+    Return the ISBN-13 form of an ISBN-10 or ISBN-13, ignoring hyphens and
+    spaces. Strings that are not valid ISBNs are returned cleaned up but
+    otherwise unchanged.
+    """
+    canonical = isbnlib.canonical(isbn)
+    return isbnlib.to_isbn13(canonical) or canonical or isbn.strip()
+
+
+def is_valid_isbn(isbn):
+    """
+    Return True if isbn is a valid ISBN-10 or ISBN-13
+    """
+    return not isbnlib.notisbn(normalise_isbn(isbn))
+
+
+class IsbnCache:
+    """
+    Books looked up by ISBN, kept in a SQLite file so they survive
+    restarts. Entries expire after ttl seconds; ISBNs that were not found
+    are remembered too, for the shorter negative_ttl. When more than
+    max_entries are stored the least recently used are evicted.
+    """
+
+    def __init__(self, path, ttl, negative_ttl, max_entries):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # the cache is shared by the bulk import threads
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+
+    def get(self, isbn):
+        """
+        Return (book, fresh) for a cached ISBN, where book is None for an
+        ISBN that was not found and fresh is False once the entry has
+        expired. Return None if the ISBN has never been cached.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT book, fetched FROM isbn_cache WHERE isbn = ?",
+                (isbn,)).fetchone()
+            if row is None:
+                return None
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE isbn_cache SET used = ? WHERE isbn = ?",
+                    (time.time(), isbn))
+        book = json.loads(row[0]) if row[0] is not None else None
+        ttl = self.ttl if book is not None else self.negative_ttl
+        return book, time.time() - row[1] < ttl
+
+    def put(self, isbn, book):
+        """
+        Cache the book found for an ISBN, or None if it was not found
+        """
+        now = time.time()
+        book = json.dumps(book) if book is not None else None
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO isbn_cache (isbn, book, fetched, used)"
+                " VALUES (?, ?, ?, ?)", (isbn, book, now, now))
+            self.connection.execute(
+                "DELETE FROM isbn_cache WHERE isbn IN ("
+                " SELECT isbn FROM isbn_cache ORDER BY used DESC"
+                " LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def clear(self):
+        """
+        Remove every cached entry
+        """
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM isbn_cache")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Return the shared ISBN cache, opening it on first use with the
+    settings from the environment
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = IsbnCache(
+                os.environ.get('BOOKWORM_ISBN_CACHE', 'isbn_cache.db'),
+                ttl=float(os.environ.get(
+                    'BOOKWORM_ISBN_CACHE_TTL', 30 * 24 * 3600)),
+                negative_ttl=float(os.environ.get(
+                    'BOOKWORM_ISBN_CACHE_NEGATIVE_TTL', 24 * 3600)),
+                max_entries=int(os.environ.get(
+                    'BOOKWORM_ISBN_CACHE_SIZE', 10000)))
+        return _cache
@@ -0,0 +1,89 @@
+"""Bulk import of books from a file of ISBNs"""
+import csv
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import metrics
+from books_api import lookup_isbn
+from isbn_cache import normalise_isbn
+
+# number of Google Books lookups in flight at once
+MAX_WORKERS = 8
+
+# books found, ISBNs Google Books has no book for, and ISBNs whose lookup
+# failed with a network or HTTP error
+ImportResult = namedtuple('ImportResult', ['books', 'not_found', 'failed'])
+
+
+def read_isbns(path):
+    """
+    Read ISBNs from a text file with one per line, or a CSV file with the
+    ISBN in the first column. Blank lines, headers and repeats are skipped.
+    """
+    isbns = []
+    seen = set()
+    with open(path, newline='', encoding='utf-8') as file:
+        for row in csv.reader(file):
+            if not row:
+                continue
+            isbn = normalise_isbn(row[0])
+            if not isbn or not isbn[:-1].isdigit() or isbn in seen:
+                continue
+            seen.add(isbn)
+            isbns.append(isbn)
+    return isbns
+
+
+def _lookup(isbn):
+    """
+    Look up one ISBN, returning an error instead of raising it so a single
+    failure does not stop the import
+    """
+    try:
+        return lookup_isbn(isbn), None
+    except (requests.exceptions.RequestException, ValueError) as error:
+        return None, error
+
+
+def resolve_isbns(isbns, workers=MAX_WORKERS, progress=None):
+    """
+    Look up every ISBN through a bounded thread pool and return an
+    ImportResult with the books in the same order as the ISBNs. progress,
+    if given, is called with the number of ISBNs done and the total. On
+    Ctrl+C the lookups not started yet are cancelled rather than waited
+    for, so the import stops straight away.
+    """
+    books, not_found, failed = [], [], []
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        results = executor.map(metrics.carry(_lookup), isbns)
+        for done, (isbn, (book, error)) in enumerate(zip(isbns, results), 1):
+            if error is not None:
+                failed.append(isbn)
+            elif book is None:
+                not_found.append(isbn)
+            else:
+                books.append(book + [isbn])
+            if progress:
+                progress(done, len(isbns))
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return ImportResult(books, not_found, failed)
+
+
+def write_report(path, result):
+    """
+    Write the ISBNs that were not imported next to the imported file and
+    return the report's path
+    """
+    report = f"{path}.not_imported.txt"
+    with open(report, 'w', encoding='utf-8') as file:
+        for isbn in result.not_found:
+            file.write(f"{isbn}\tnot found\n")
+        for isbn in result.failed:
+            file.write(f"{isbn}\tlookup failed\n")
+    return report
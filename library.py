@@ -0,0 +1,595 @@
+"""In-memory, write-through cache of a user's library"""
+import bisect
+import functools
+import os
+import sys
+import threading
+from collections import Counter
+from difflib import SequenceMatcher
+
+from storage import HEADERS, BookChangedError, row_checksum
+from search_index import BKTree, NgramIndex
+from isbn_cache import normalise_isbn
+
+# fields with an n-gram index for substring search. Genres are few, so
+# they are searched by scanning the distinct genres of the genre hash.
+INDEXED_FIELDS = ['Title', 'Author']
+
+# what books are counted by in the library statistics
+FACETS = ['Genre', 'Author', 'Decade']
+
+# most books sent to the storage backend in one bulk write
+CHUNK_SIZE = 500
+
+# most edits a title can be from the one asked for and still be suggested
+MAX_TITLE_DISTANCE = int(os.environ.get('BOOKWORM_TITLE_DISTANCE', 2))
+
+# most books suggested for a title that matches no book exactly
+SHORTLIST_SIZE = 5
+
+
+class Book:
+    """
+    A book of a loaded library, in HEADERS order. Uses slots instead of a
+    dict or list per book, and shares one copy of each author, year and
+    genre between every book that has it, so a large library takes a
+    fraction of the memory. Books are read by attribute or, like the rows
+    they come from, by position.
+    """
+    __slots__ = ('title', 'author', 'year', 'genre', 'isbn')
+
+    def __init__(self, title, author, year, genre, isbn):
+        self.title = title
+        self.author = sys.intern(author)
+        self.year = sys.intern(year)
+        self.genre = sys.intern(genre)
+        self.isbn = isbn
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Make a book from a row of the storage backend, padding or trimming
+        it to exactly one string per header
+        """
+        row = [str(value) for value in row[:len(HEADERS)]]
+        return cls(*row, *[''] * (len(HEADERS) - len(row)))
+
+    def __iter__(self):
+        return iter((self.title, self.author, self.year, self.genre,
+                     self.isbn))
+
+    def __len__(self):
+        return len(HEADERS)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return list(self)[position]
+        return getattr(self, self.__slots__[position])
+
+    def __eq__(self, other):
+        if isinstance(other, Book):
+            other = list(other)
+        return list(self) == other
+
+    def __repr__(self):
+        return f"Book{tuple(self)!r}"
+
+    def row(self):
+        """
+        Return the book as a row for the storage backend
+        """
+        return list(self)
+
+
+def decade(year):
+    """
+    Return the decade of a year such as '1954' as '1950s', or 'Unknown'
+    """
+    return f"{int(year) // 10 * 10}s" if year.isdigit() else 'Unknown'
+
+
+def loaded(method):
+    """
+    Make a Library method load every book first if they are not loaded yet,
+    and hold the library's lock while it runs
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class Library:
+    """
+    Holds every book in a user's library in memory so that reads are
+    served locally instead of downloading the whole library again. Writes
+    are sent to the storage backend first and only applied to the cache
+    once they have succeeded, so the cache always matches the backend.
+
+    Nothing is read until it is needed: pages of books can be read straight
+    from the backend with get_range, and everything else loads the whole
+    library the first time it is used.
+
+    Each book gets a book id that stays the same while the library is
+    loaded, even when books before it are removed. Ids grow in library
+    order, so sorting ids gives the books back in the order they are
+    stored.
+
+    A library can be shared by several sessions of the same user, so
+    every method that loads the library holds its lock, and changing a
+    book another session has removed raises BookChangedError.
+
+    Changes made through other sessions or processes are picked up with
+    refresh, which only reads the books that changed.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.books = {}
+        self.ids = []
+        self.indexes = {field: NgramIndex() for field in INDEXED_FIELDS}
+        self.isbns = {}
+        self.facets = {facet: Counter() for facet in FACETS}
+        self.titles = None
+        self.genres = None
+        self.years = None
+        self.checksums = None
+        self.revision = None
+        self.next_id = 0
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def load(self):
+        """
+        (Re)load every book from the storage backend with a single read.
+        The books are read before the cache is cleared, so if the read
+        fails the library is left as it was.
+        """
+        with self.lock:
+            revision, rows = self.store.get_revision_and_rows()
+            self.books = {}
+            self.ids = []
+            self.indexes = {field: NgramIndex() for field in INDEXED_FIELDS}
+            self.isbns = {}
+            self.facets = {facet: Counter() for facet in FACETS}
+            self.titles = None
+            self.genres = None
+            self.years = None
+            self.checksums = None
+            self.revision = revision
+            for row in rows:
+                self._insert(Book.from_row(row))
+            self.loaded = True
+
+    def unload(self):
+        """
+        Forget the cached books, so they are loaded again the next time
+        they are used
+        """
+        with self.lock:
+            self.loaded = False
+
+    def _write(self, write, *args):
+        """
+        Make a write to the storage backend, telling it first which
+        revision the cache is up to date with. The backend only returns
+        the revision the write gave it if it was still at that one just
+        before the write, and the library then takes it on, so the next
+        refresh does not read the checksums only to find this session's
+        own change. Otherwise the revision is left as it was, and the next
+        refresh compares the checksums.
+        """
+        self.store.expect_revision(self.revision)
+        revision = write(*args)
+        if self.revision is not None and revision is not None:
+            self.revision = revision
+
+    def _insert(self, book):
+        """
+        Add a book to the end of the cache and its indexes
+        """
+        book_id = self.next_id
+        self.next_id += 1
+        self.books[book_id] = book
+        self.ids.append(book_id)
+        self._index(book_id, book)
+        return book_id
+
+    def _index(self, book_id, book):
+        """
+        (Re)index every searchable field of a book
+        """
+        for field, index in self.indexes.items():
+            index.add(book_id, getattr(book, field.lower()))
+        for facet, value in self._facet_values(book):
+            self.facets[facet][value] += 1
+        if self.titles is not None:
+            self.titles.add(book_id, book.title)
+        if self.genres is not None:
+            self.genres.setdefault(book.genre.lower(), set()).add(book_id)
+        if self.years is not None and book.year.isdigit():
+            bisect.insort(self.years, (int(book.year), book_id))
+        if self.checksums is not None:
+            self.checksums[book_id] = row_checksum(book)
+        if book.isbn:
+            isbn = normalise_isbn(book.isbn)
+            self.isbns.setdefault(isbn, set()).add(book_id)
+
+    @staticmethod
+    def _facet_values(book):
+        """
+        Return (facet, value) for every facet a book is counted under
+        """
+        return (('Genre', book.genre), ('Author', book.author),
+                ('Decade', decade(book.year)))
+
+    def _unindex(self, book_id):
+        """
+        Drop a book from every index
+        """
+        for index in self.indexes.values():
+            index.remove(book_id)
+        if self.titles is not None:
+            self.titles.remove(book_id)
+        book = self.books[book_id]
+        for facet, value in self._facet_values(book):
+            counts = self.facets[facet]
+            counts[value] -= 1
+            if not counts[value]:
+                del counts[value]
+        if self.genres is not None:
+            genre = book.genre.lower()
+            self.genres[genre].discard(book_id)
+            if not self.genres[genre]:
+                del self.genres[genre]
+        if self.years is not None and book.year.isdigit():
+            del self.years[bisect.bisect_left(
+                self.years, (int(book.year), book_id))]
+        if self.checksums is not None:
+            del self.checksums[book_id]
+        isbn = book.isbn
+        if isbn:
+            isbn = normalise_isbn(isbn)
+            self.isbns[isbn].discard(book_id)
+            if not self.isbns[isbn]:
+                del self.isbns[isbn]
+
+    def refresh(self):
+        """
+        Bring a loaded library up to date with changes made elsewhere,
+        reading only the books that changed, and return True if any had.
+        The backend's revision is checked first, so an unchanged library
+        costs one small read. Then the checksums of the backend's books are
+        lined up with the cached ones; books that were changed or removed
+        are updated or dropped in place and books added at the end are
+        read and appended. Books added anywhere else would break the order
+        of the book ids, so then the whole library is loaded again.
+        """
+        with self.lock:
+            if not self.loaded:
+                return False
+            if self.revision is not None:
+                revision = self.store.get_revision()
+                if revision is None or revision == self.revision:
+                    return False
+            revision, checksums = self.store.get_checksums()
+            if revision is None:
+                return False
+            if self.checksums is None:
+                self.checksums = {book_id: row_checksum(self.books[book_id])
+                                  for book_id in self.ids}
+            cached = [self.checksums[book_id] for book_id in self.ids]
+            changes = [opcode for opcode in SequenceMatcher(
+                None, cached, checksums, autojunk=False).get_opcodes()
+                       if opcode[0] != 'equal']
+            if any(stop - start < new_stop - new_start
+                   and stop < len(cached)
+                   for _, start, stop, new_start, new_stop in changes):
+                self.load()
+                return True
+            ranges = [(new_start, new_stop)
+                      for _, _, _, new_start, new_stop in changes
+                      if new_stop > new_start]
+            rows = iter(self.store.get_ranges(ranges))
+            fetched = {new_range: next(rows) for new_range in ranges}
+            if any(len(books) != stop - start
+                   for (start, stop), books in fetched.items()):
+                # the library changed again while it was being read
+                self.load()
+                return True
+            # from the end, so the positions of earlier changes still hold
+            for _, start, stop, new_start, new_stop in reversed(changes):
+                books = [Book.from_row(row) for row in
+                         fetched.get((new_start, new_stop), [])]
+                replaced = self.ids[start:stop]
+                for book_id, book in zip(replaced, books):
+                    self._unindex(book_id)
+                    self.books[book_id] = book
+                    self._index(book_id, book)
+                for book_id in replaced[len(books):]:
+                    self._unindex(book_id)
+                    del self.books[book_id]
+                del self.ids[start + len(books):stop]
+                for book in books[len(replaced):]:
+                    self._insert(book)
+            self.revision = revision
+            return bool(changes)
+
+    @loaded
+    def __len__(self):
+        return len(self.ids)
+
+    def count(self):
+        """
+        Return the number of books, from the cache if it is loaded or else
+        the backend's (possibly over-estimated) count
+        """
+        if self.loaded:
+            return len(self.ids)
+        return self.store.count_rows()
+
+    def get_range(self, start, stop):
+        """
+        Return the books at positions start to stop - 1, from the cache if
+        it is loaded or else with a ranged read from the backend
+        """
+        if self.loaded:
+            return [self.books[book_id] for book_id in self.ids[start:stop]]
+        return [Book.from_row(row)
+                for row in self.store.get_range(start, stop)]
+
+    @loaded
+    def book_ids(self):
+        """
+        Return the id of every book in library order
+        """
+        return list(self.ids)
+
+    def _check(self, book_id):
+        """
+        Raise BookChangedError if a book is no longer in the library, as
+        another session removed it or reloaded the library since its id
+        was looked up
+        """
+        if book_id not in self.books:
+            raise BookChangedError(
+                "the book was changed in another session, please try again")
+
+    @loaded
+    def get(self, book_id):
+        """
+        Return the book with this id
+        """
+        self._check(book_id)
+        return self.books[book_id]
+
+    @loaded
+    def find_title(self, title):
+        """
+        Return the id of the first book with exactly this title, or None
+        """
+        matches = [book_id for book_id in self.indexes['Title'].search(title)
+                   if self.books[book_id].title == title]
+        return min(matches) if matches else None
+
+    @loaded
+    def find_untagged_title(self, title):
+        """
+        Return the id of the first book with exactly this title and no
+        ISBN recorded, or None
+        """
+        matches = [book_id for book_id in self.indexes['Title'].search(title)
+                   if self.books[book_id].title == title
+                   and not self.books[book_id].isbn]
+        return min(matches) if matches else None
+
+    @loaded
+    def closest_titles(self, title, max_distance=MAX_TITLE_DISTANCE,
+                       limit=SHORTLIST_SIZE):
+        """
+        Return the ids of up to limit books whose titles are within
+        max_distance edits of title, ignoring case, closest first. The
+        BK-tree of titles is only built the first time it is needed.
+        """
+        if self.titles is None:
+            self.titles = BKTree()
+            for book_id in self.ids:
+                self.titles.add(book_id, self.books[book_id].title)
+        matches = self.titles.search(title, max_distance)
+        return [book_id for _, book_id in matches[:limit]]
+
+    @loaded
+    def top(self, facet, limit=None):
+        """
+        Return (value, number of books) for the limit most common values of
+        a facet, or all of them, most common first. The counts are kept up
+        to date as books change, so this never looks at the books.
+        """
+        return self.facets[facet].most_common(limit)
+
+    @loaded
+    def facet_size(self, facet):
+        """
+        Return the number of different values of a facet
+        """
+        return len(self.facets[facet])
+
+    @loaded
+    def find_isbn(self, isbn):
+        """
+        Return the id of the first book with this ISBN, or None
+        """
+        book_ids = self.isbns.get(normalise_isbn(isbn))
+        return min(book_ids) if book_ids else None
+
+    @loaded
+    def search(self, field, text):
+        """
+        Return the books whose field contains text, ignoring case
+        """
+        if field == 'Genre':
+            book_ids = self._genre_ids(text)
+        else:
+            book_ids = self.indexes[field].search(text)
+        return [self.books[book_id] for book_id in sorted(book_ids)]
+
+    def _genre_ids(self, text):
+        """
+        Return the ids of the books whose genre contains text, ignoring
+        case, from the distinct genres of the genre hash
+        """
+        self._build_field_indexes()
+        text = text.lower()
+        book_ids = set()
+        for genre, genre_ids in self.genres.items():
+            if text in genre:
+                book_ids |= genre_ids
+        return book_ids
+
+    def _build_field_indexes(self):
+        """
+        Build the genre and year indexes the first time a query needs them
+        """
+        if self.genres is None:
+            self.genres = {}
+            for book_id, book in self.books.items():
+                self.genres.setdefault(book.genre.lower(), set()).add(book_id)
+        if self.years is None:
+            self.years = sorted((int(book.year), book_id)
+                                for book_id, book in self.books.items()
+                                if book.year.isdigit())
+
+    def _year_span(self, first, last):
+        """
+        Return the slice of the year index holding the years first to last,
+        either of which may be None for an open end
+        """
+        start = 0 if first is None else \
+            bisect.bisect_left(self.years, (first, -1))
+        stop = len(self.years) if last is None else \
+            bisect.bisect_left(self.years, (last + 1, -1))
+        return slice(start, stop)
+
+    def _in_years(self, book_id, first, last):
+        """
+        Return True if a book was published in the years first to last
+        """
+        year = self.books[book_id].year
+        return (year.isdigit()
+                and (first is None or int(year) >= first)
+                and (last is None or int(year) <= last))
+
+    @loaded
+    def query(self, terms):
+        """
+        Return the books that match every (field, value) term of a parsed
+        query, in library order
+        """
+        return [self.books[book_id] for book_id in self.query_ids(terms)]
+
+    @loaded
+    def query_ids(self, terms):
+        """
+        Return the ids of the books that match every (field, value) term of
+        a parsed query, in library order. Each term is answered from an
+        index: the n-gram indexes for title and author, a hash of genres and
+        a sorted list of years searched with bisect. The matches are
+        intersected smallest first, and a year range with more books in it
+        than are left is checked book by book instead, so the work depends
+        on the matches rather than the size of the library.
+        """
+        self._build_field_indexes()
+        matches = []
+        for field, value in terms:
+            if field == 'year':
+                span = self._year_span(*value)
+                matches.append((span.stop - span.start, field, span, value))
+            elif field == 'genre':
+                book_ids = self.genres.get(value.lower(), set())
+                matches.append((len(book_ids), field, book_ids, value))
+            else:
+                book_ids = self.indexes[field.capitalize()].search(value)
+                matches.append((len(book_ids), field, book_ids, value))
+        matches.sort(key=lambda match: match[0])
+
+        book_ids = None
+        for size, field, found, value in matches:
+            if field == 'year' and book_ids is not None \
+                    and size > len(book_ids):
+                book_ids = {book_id for book_id in book_ids
+                            if self._in_years(book_id, *value)}
+                continue
+            if field == 'year':
+                found = {book_id for _, book_id in self.years[found]}
+            book_ids = set(found) if book_ids is None else book_ids & found
+            if not book_ids:
+                break
+        return sorted(book_ids or ())
+
+    @loaded
+    def append(self, book):
+        """
+        Add a book to the end of the library and return its id
+        """
+        book = Book.from_row(book)
+        self._write(self.store.append_row, book.row())
+        return self._insert(book)
+
+    @loaded
+    def extend(self, books, chunk_size=CHUNK_SIZE):
+        """
+        Add many books to the end of the library, writing them to the
+        storage backend in chunks of chunk_size
+        """
+        books = [Book.from_row(book) for book in books]
+        for start in range(0, len(books), chunk_size):
+            chunk = books[start:start + chunk_size]
+            self._write(self.store.append_rows,
+                        [book.row() for book in chunk])
+            for book in chunk:
+                self._insert(book)
+
+    @loaded
+    def delete(self, book_id):
+        """
+        Remove a book from the library
+        """
+        self._check(book_id)
+        position = self.ids.index(book_id)
+        self._write(self.store.delete_row, position)
+        del self.ids[position]
+        self._unindex(book_id)
+        del self.books[book_id]
+
+    @loaded
+    def delete_many(self, book_ids):
+        """
+        Remove several books from the library with a single write
+        """
+        book_ids = set(book_ids)
+        for book_id in book_ids:
+            self._check(book_id)
+        positions = [position for position, book_id in enumerate(self.ids)
+                     if book_id in book_ids]
+        self._write(self.store.delete_rows, positions)
+        self.ids = [book_id for book_id in self.ids
+                    if book_id not in book_ids]
+        for book_id in book_ids:
+            self._unindex(book_id)
+            del self.books[book_id]
+
+    @loaded
+    def update(self, book_id, book):
+        """
+        Replace a book in the library
+        """
+        self._check(book_id)
+        book = Book.from_row(book)
+        self._write(self.store.update_row, self.ids.index(book_id),
+                    book.row())
+        self._unindex(book_id)
+        self.books[book_id] = book
+        self._index(book_id, book)
@@ -0,0 +1,235 @@
+"""
+Instrumentation of the calls book-worm makes to Google Sheets, Google
+Books and Argon2.
+
+Each call is recorded under the menu action that made it, such as
+add_book_isbn or search_books_by_author, with its latency in a histogram
+and the size of its response. A snapshot of the metrics is written when
+book-worm exits and whenever it receives SIGUSR1.
+
+Enabled by setting BOOKWORM_METRICS to the path of the snapshot: a path
+ending in .prom gets the Prometheus text format, anything else JSON. When
+it is not set, menu actions are not wrapped and calls cost one flag check.
+"""
+import atexit
+import contextvars
+import functools
+import json
+import os
+import signal
+import threading
+import time
+from urllib.parse import urlsplit
+
+PATH = os.environ.get('BOOKWORM_METRICS')
+ENABLED = bool(PATH)
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           float('inf'))
+
+# the menu action calls are recorded under
+CURRENT_ACTION = contextvars.ContextVar('action', default='none')
+
+
+class Series:
+    """
+    Call count, errors, latency histogram and response bytes of one kind
+    of call made by one action
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds, size, error):
+        self.count += 1
+        self.errors += error
+        self.seconds += seconds
+        self.bytes += size
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+
+
+class Registry:
+    """
+    Every Series recorded, keyed by (action, api, call)
+    """
+
+    def __init__(self):
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def record(self, api, call, seconds, size=0, error=False):
+        """
+        Record one call to api under the current action
+        """
+        key = (CURRENT_ACTION.get(), api, call)
+        with self.lock:
+            if key not in self.series:
+                self.series[key] = Series()
+            self.series[key].observe(seconds, size, error)
+
+    def snapshot(self):
+        """
+        Return the metrics as a list of dicts, one per series, with the
+        histogram buckets cumulative as Prometheus expects
+        """
+        with self.lock:
+            items = sorted(self.series.items())
+            return [{
+                'action': action,
+                'api': api,
+                'call': call,
+                'count': series.count,
+                'errors': series.errors,
+                'seconds': series.seconds,
+                'bytes': series.bytes,
+                'buckets': {
+                    str(bound): total for bound, total in zip(
+                        BUCKETS, _cumulative(series.buckets))
+                },
+            } for (action, api, call), series in items]
+
+    def prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        entries = self.snapshot()
+        for entry in entries:
+            entry['labels'] = (f'action="{entry["action"]}",'
+                               f'api="{entry["api"]}",'
+                               f'call="{_escape(entry["call"])}"')
+        lines = []
+        for name, field in [('bookworm_calls_total', 'count'),
+                            ('bookworm_call_errors_total', 'errors'),
+                            ('bookworm_response_bytes_total', 'bytes')]:
+            lines.append(f'# TYPE {name} counter')
+            lines.extend(f'{name}{{{entry["labels"]}}} {entry[field]}'
+                         for entry in entries)
+        lines.append('# TYPE bookworm_call_seconds histogram')
+        for entry in entries:
+            for bound, total in entry['buckets'].items():
+                bound = '+Inf' if bound == 'inf' else bound
+                lines.append(f'bookworm_call_seconds_bucket{{'
+                             f'{entry["labels"]},le="{bound}"}} {total}')
+            lines.append(f'bookworm_call_seconds_sum{{{entry["labels"]}}} '
+                         f'{entry["seconds"]}')
+            lines.append(f'bookworm_call_seconds_count{{{entry["labels"]}}} '
+                         f'{entry["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Write a snapshot to path, as Prometheus text if it ends in .prom
+        and JSON otherwise
+        """
+        if path.endswith('.prom'):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=2)
+        temp = f"{path}.tmp"
+        with open(temp, 'w', encoding='utf-8') as file:
+            file.write(text)
+        os.replace(temp, path)
+
+
+def _cumulative(counts):
+    total = 0
+    for count in counts:
+        total += count
+        yield total
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+REGISTRY = Registry()
+
+
+def action(func):
+    """
+    Decorator recording the calls made while func runs under its name
+    """
+    if not ENABLED:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = CURRENT_ACTION.set(func.__name__)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            CURRENT_ACTION.reset(token)
+    return wrapper
+
+
+def carry(func):
+    """
+    Return func bound to the current action, for running on another
+    thread
+    """
+    if not ENABLED:
+        return func
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # a context can only be entered by one thread at a time
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+def call(api, name, func):
+    """
+    Call func, recording its latency and the size of the response it
+    returns under api and name
+    """
+    if not ENABLED:
+        return func()
+    start = time.perf_counter()
+    try:
+        response = func()
+    except Exception:
+        REGISTRY.record(api, name, time.perf_counter() - start, error=True)
+        raise
+    size = len(getattr(response, 'content', b'') or b'')
+    REGISTRY.record(api, name, time.perf_counter() - start, size)
+    return response
+
+
+def endpoint_name(method, url):
+    """
+    Name a Google API request by its method and the kind of endpoint,
+    leaving out ids and ranges: 'GET values', 'POST values:append' or
+    'POST spreadsheets:batchUpdate'. gspread quotes ranges in URLs, so a
+    colon left in the path always starts a custom method.
+    """
+    path = urlsplit(url).path
+    resource, _, verb = path.rpartition('/')[2].partition(':')
+    if '/values' in path:
+        resource = 'values'
+    elif '/spreadsheets' in path:
+        resource = 'spreadsheets'
+    return f"{method.upper()} {resource}{':' + verb if verb else ''}"
+
+
+def install(path=PATH):
+    """
+    Write a snapshot to path on exit and on SIGUSR1
+    """
+    if not ENABLED:
+        return
+    atexit.register(REGISTRY.write, path)
+    if hasattr(signal, 'SIGUSR1'):
+        # the handler runs between two bytecodes of the main thread, which
+        # may hold the registry's lock, so the write is left to a thread
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(
+            target=REGISTRY.write, args=(path,), name='metrics-write',
+            daemon=True).start())
@@ -0,0 +1,82 @@
+"""
+Move user libraries into the shard spreadsheets.
+
+Libraries created before sharding are worksheets of the main book_worm
+spreadsheet. This moves each of them to the shard its username hashes
+to, where a new library for that user would be created, using the shard
+spreadsheets named in BOOKWORM_SHARDS. Every move copies the worksheet,
+records the new shard in the users worksheet and only then deletes the
+old worksheet, so it can be run again if it stops part way.
+
+Run it while nobody is using book-worm: a session with a library open
+keeps writing to the old worksheet. A library that is written to while
+it is being moved is left where it was and reported, so no change is
+lost, and is moved by running the migration again.
+
+    BOOKWORM_SHARDS=book_worm_1,book_worm_2 python migrate_shards.py
+
+--dry-run lists the moves without making them. --rebalance also moves
+libraries that are already in a shard but hash to a different one, as
+they do after a shard is added.
+"""
+import argparse
+
+from storage import StorageError, open_storage
+from storage.sheets import shard_for
+
+
+def plan_moves(storage, rebalance=False):
+    """
+    Return the moves to make as (username, current shard, new shard),
+    where the main spreadsheet is the shard ''
+    """
+    storage.directory.refresh()
+    moves = []
+    for username in sorted(storage.directory.users):
+        current = storage.route(username)
+        target = shard_for(username, storage.shards)
+        if current != target and (rebalance or not current):
+            moves.append((username, current, target))
+    return moves
+
+
+def migrate(storage, rebalance=False, dry_run=False):
+    """
+    Move every library that needs moving and return the number moved.
+    A library that cannot be moved is reported and left where it is.
+    """
+    moved = 0
+    for username, current, target in plan_moves(storage, rebalance):
+        print(f"{username}: {current or 'main'} -> {target}")
+        if dry_run:
+            continue
+        try:
+            storage.move_library(username, target)
+        except StorageError as error:
+            print(f"  not moved: {error}")
+            continue
+        moved += 1
+    return moved
+
+
+def main():
+    """
+    Parse the command line and move the libraries
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--dry-run', action='store_true',
+                        help="list the moves without making them")
+    parser.add_argument('--rebalance', action='store_true',
+                        help="also move libraries between shards")
+    args = parser.parse_args()
+
+    storage = open_storage('sheets')
+    if not storage.shards:
+        parser.error("set BOOKWORM_SHARDS to the shard spreadsheet names")
+    moved = migrate(storage, args.rebalance, args.dry_run)
+    if not args.dry_run:
+        print(f"{moved} libraries moved")
+
+
+if __name__ == '__main__':
+    main()
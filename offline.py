@@ -0,0 +1,361 @@
+"""
+Offline-capable libraries backed by a local write-ahead journal.
+
+Every change is first appended to a journal file on disk and applied to a
+local replica of the library, so it is never lost and the menus do not
+wait for the network. A background syncer replays the journal to the
+real storage backend in order, checking before each delete or update that
+the book it changes is still what the replica expected, and records a
+conflict instead of applying the change if it is not.
+
+Enabled by setting BOOKWORM_OFFLINE=1. The journal, the replica snapshot
+and any conflicts are kept in BOOKWORM_OFFLINE_DIR ('offline' by default).
+"""
+import json
+import logging
+import os
+import threading
+
+from storage import HEADERS, LibraryStore, StorageError
+
+LOG = logging.getLogger(__name__)
+
+# seconds between attempts to sync while the backend is unreachable
+RETRY_INTERVAL = 30
+
+# synced changes kept in the journal before it is folded into the snapshot
+COMPACT_AFTER = 500
+
+
+def _normalise(row):
+    """
+    Pad or trim a row to exactly one string per header
+    """
+    row = [str(value) for value in row[:len(HEADERS)]]
+    return row + [''] * (len(HEADERS) - len(row))
+
+
+def apply_entry(rows, entry):
+    """
+    Apply a journal entry to a list of rows in place
+    """
+    if entry['op'] == 'append':
+        rows.append(entry['book'])
+    elif entry['op'] == 'delete':
+        del rows[entry['index']]
+    elif entry['op'] == 'update':
+        rows[entry['index']] = entry['book']
+
+
+def _write_json(path, data):
+    """
+    Replace a JSON file atomically and durably
+    """
+    temp = f"{path}.tmp"
+    with open(temp, 'w', encoding='utf-8') as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp, path)
+
+
+class Journal:
+    """
+    The files kept for one user's library: the journal of changes, the
+    sequence number of the last change synced, and a snapshot of the
+    replica including every change up to its own sequence number.
+    """
+
+    def __init__(self, directory, name):
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, name)
+        self.journal_path = f"{base}.journal"
+        self.synced_path = f"{base}.synced"
+        self.snapshot_path = f"{base}.snapshot.json"
+        self.conflicts_path = f"{base}.conflicts"
+        self.entries = self._read_entries()
+        self.synced = self._read_synced()
+
+    def _read_entries(self):
+        entries = []
+        try:
+            with open(self.journal_path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # a write cut short by a crash; nothing follows it
+                        break
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _read_synced(self):
+        try:
+            with open(self.synced_path, encoding='utf-8') as file:
+                return int(file.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    @property
+    def last_seq(self):
+        """
+        Sequence number of the newest change, or the synced one if the
+        journal is empty
+        """
+        return self.entries[-1]['seq'] if self.entries else self.synced
+
+    def pending(self):
+        """
+        Return the changes not yet synced, oldest first
+        """
+        return [entry for entry in self.entries
+                if entry['seq'] > self.synced]
+
+    def append(self, entry):
+        """
+        Durably add a change to the journal and return it
+        """
+        entry = dict(entry, seq=self.last_seq + 1)
+        with open(self.journal_path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        self.entries.append(entry)
+        return entry
+
+    def mark_synced(self, seq):
+        """
+        Record that every change up to seq has been synced
+        """
+        with open(self.synced_path, 'w', encoding='utf-8') as file:
+            file.write(str(seq))
+            file.flush()
+            os.fsync(file.fileno())
+        self.synced = seq
+
+    def read_snapshot(self):
+        """
+        Return the saved replica, with the changes made since it was saved
+        applied, or None if there is no snapshot
+        """
+        try:
+            with open(self.snapshot_path, encoding='utf-8') as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return None
+        rows = snapshot['rows']
+        for entry in self.entries:
+            if entry['seq'] > snapshot['seq']:
+                apply_entry(rows, entry)
+        return rows
+
+    def save_snapshot(self, rows):
+        """
+        Save the replica, which includes every change in the journal, and
+        drop the changes that have already been synced
+        """
+        _write_json(self.snapshot_path,
+                    {'seq': self.last_seq, 'rows': rows})
+        pending = self.pending()
+        temp = f"{self.journal_path}.tmp"
+        with open(temp, 'w', encoding='utf-8') as file:
+            for entry in pending:
+                file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, self.journal_path)
+        self.entries = pending
+
+    def record_conflict(self, entry, found):
+        """
+        Keep a change that could not be applied, with what was found instead
+        """
+        with open(self.conflicts_path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps({'entry': entry, 'found': found}) + '\n')
+
+
+class JournaledLibrary(LibraryStore):
+    """
+    A LibraryStore that applies changes to a local replica and the journal
+    straight away, leaving the remote store to be updated by sync()
+    """
+
+    def __init__(self, remote, journal):
+        self.remote = remote
+        self.journal = journal
+        self.rows = None
+        self.conflicts = []
+        self.on_change = None
+        self.lock = threading.RLock()
+        # held while a change is being replayed, so the remote store is
+        # never read half way through one
+        self.sync_lock = threading.Lock()
+
+    def get_rows(self):
+        with self.sync_lock, self.lock:
+            try:
+                rows = [_normalise(row) for row in self.remote.get_rows()]
+            except StorageError:
+                rows = self.journal.read_snapshot()
+                if rows is None:
+                    raise
+            else:
+                # the remote store does not have the pending changes yet
+                for entry in self.journal.pending():
+                    apply_entry(rows, entry)
+                self.journal.save_snapshot(rows)
+            self.rows = rows
+            return list(rows)
+
+    def _load_replica(self):
+        """
+        Load the replica if it has not been loaded yet. Must be called
+        without holding self.lock, as loading takes sync_lock first.
+        """
+        if self.rows is None:
+            self.get_rows()
+
+    def count_rows(self):
+        self._load_replica()
+        with self.lock:
+            return len(self.rows)
+
+    def get_range(self, start, stop):
+        self._load_replica()
+        with self.lock:
+            return self.rows[start:stop]
+
+    def _record(self, make_entry):
+        """
+        Journal the change make_entry builds from the replica and apply it
+        """
+        self._load_replica()
+        with self.lock:
+            entry = self.journal.append(make_entry(self.rows))
+            apply_entry(self.rows, entry)
+        if self.on_change:
+            self.on_change()
+
+    def append_row(self, row):
+        self._record(lambda rows: {'op': 'append', 'book': _normalise(row)})
+
+    def delete_row(self, index):
+        self._record(lambda rows: {'op': 'delete', 'index': index,
+                                   'old': rows[index]})
+
+    def update_row(self, index, row):
+        self._record(lambda rows: {'op': 'update', 'index': index,
+                                   'old': rows[index],
+                                   'book': _normalise(row)})
+
+    @property
+    def pending_count(self):
+        """
+        Number of changes waiting to be synced
+        """
+        with self.lock:
+            return len(self.journal.pending())
+
+    def _replay(self, entry):
+        """
+        Apply one change to the remote store, returning False if the book
+        it changes is no longer the one the replica expected
+        """
+        if entry['op'] == 'append':
+            self.remote.append_row(entry['book'])
+            return True
+        found = self.remote.get_range(entry['index'], entry['index'] + 1)
+        found = _normalise(found[0]) if found else None
+        if found != entry['old']:
+            self.journal.record_conflict(entry, found)
+            self.conflicts.append(entry)
+            return False
+        if entry['op'] == 'delete':
+            self.remote.delete_row(entry['index'])
+        else:
+            self.remote.update_row(entry['index'], entry['book'])
+        return True
+
+    def sync(self):
+        """
+        Replay pending changes to the remote store in order. Stops at the
+        first StorageError, leaving the rest for the next attempt. Returns
+        True once nothing is left to sync.
+        """
+        while True:
+            with self.lock:
+                pending = self.journal.pending()
+            if not pending:
+                break
+            entry = pending[0]
+            with self.sync_lock:
+                try:
+                    self._replay(entry)
+                except StorageError:
+                    return False
+                with self.lock:
+                    self.journal.mark_synced(entry['seq'])
+        with self.lock:
+            synced = len(self.journal.entries) - len(self.journal.pending())
+            if self.rows is not None and synced >= COMPACT_AFTER:
+                self.journal.save_snapshot(self.rows)
+        return True
+
+
+class Syncer:
+    """
+    Background thread that syncs a JournaledLibrary whenever it is told
+    about a change, and retries regularly while the backend is unreachable
+    """
+
+    def __init__(self, library, interval=RETRY_INTERVAL):
+        self.library = library
+        self.interval = interval
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name='syncer',
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.library.sync()
+            # the changes stay in the journal whatever went wrong, so keep
+            # the thread alive to try them again
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception("syncing the offline journal failed")
+            if self.stopped:
+                return
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def notify(self):
+        """
+        Sync as soon as possible
+        """
+        self.wake.set()
+
+    def stop(self, timeout=10):
+        """
+        Try a last sync, waiting at most timeout seconds, and stop. Returns
+        the number of changes still waiting, which stay in the journal for
+        next time.
+        """
+        self.stopped = True
+        self.wake.set()
+        self.thread.join(timeout)
+        return self.library.pending_count
+
+
+def open_offline_library(remote, username):
+    """
+    Wrap a user's LibraryStore in a JournaledLibrary and start syncing it
+    """
+    journal = Journal(os.environ.get('BOOKWORM_OFFLINE_DIR', 'offline'),
+                      username)
+    library = JournaledLibrary(remote, journal)
+    syncer = Syncer(library)
+    library.on_change = syncer.notify
+    return library, syncer
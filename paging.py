@@ -0,0 +1,73 @@
+"""Page-at-a-time reading of books with the neighbouring pages prefetched"""
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+def prefetcher():
+    """
+    Return a new executor for Pagers to prefetch with. Each session has
+    its own, so that one session's prefetches never queue behind
+    another's, and one worker is enough to stay a page ahead of one reader.
+    """
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+
+
+class Pager:
+    """
+    Reads books a page at a time through fetch(start, stop), which returns
+    the books at positions start to stop - 1. count is the number of books,
+    which may be an over-estimate: a page that comes back short corrects
+    it. Given a prefetcher, after each page is shown the next and previous
+    pages are fetched in the background on it so that turning the page
+    does not wait.
+    """
+
+    def __init__(self, fetch, count, page_size, prefetcher=None):
+        self.fetch = fetch
+        self.count = count
+        self.page_size = page_size
+        self.prefetcher = prefetcher
+        self.pages = {}
+
+    @property
+    def total_pages(self):
+        """
+        Number of pages, at least one even for no books
+        """
+        return max(1, (self.count + self.page_size - 1) // self.page_size)
+
+    def _request(self, page):
+        """
+        Start fetching a page (0-based) unless it is already fetched
+        """
+        if page not in self.pages and 0 <= page < self.total_pages:
+            start = page * self.page_size
+            stop = start + self.page_size
+            if self.prefetcher is not None:
+                self.pages[page] = self.prefetcher.submit(
+                    metrics.carry(self.fetch), start, stop)
+            else:
+                self.pages[page] = self.fetch(start, stop)
+
+    def page(self, page):
+        """
+        Return the books on a page (0-based) and prefetch its neighbours.
+        The page asked for may move back if the count was an over-estimate
+        and the page turned out to be past the end; the page actually shown
+        is returned with the books.
+        """
+        while True:
+            self._request(page)
+            books = self.pages[page]
+            if self.prefetcher is not None:
+                books = books.result()
+            if len(books) < self.page_size:
+                # the end of the books is on this page
+                self.count = page * self.page_size + len(books)
+            if books or page == 0:
+                break
+            page = min(page - 1, self.total_pages - 1)
+        self._request(page + 1)
+        self._request(page - 1)
+        return page, books
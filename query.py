@@ -0,0 +1,83 @@
+"""
+The search query language.
+
+A query is a list of terms separated by spaces, every one of which a book
+must match:
+
+    author:tolkien genre:fantasy year:1950..1960
+
+title: and author: match books whose field contains the text, genre:
+matches the whole genre, and year: matches a year or a range of years,
+either end of which can be left open (year:..1960, year:1950..). Values
+with spaces are put in double quotes (genre:"science fiction"), and a
+term without a field matches the title. Case is ignored throughout.
+"""
+import re
+import shlex
+from collections import namedtuple
+
+FIELDS = ('title', 'author', 'genre', 'year')
+
+# a year, or a range of years with either end left open
+YEAR = re.compile(r'^(\d*)(\.\.)?(\d*)$')
+
+# a term of a query. value is the text to match, or (first, last) years
+# for year terms, with None for an open end
+Term = namedtuple('Term', ['field', 'value'])
+
+
+class QueryError(ValueError):
+    """
+    Raised when a query cannot be parsed
+    """
+
+
+def parse_year(text):
+    """
+    Return the (first, last) years of a year or range of years
+    """
+    match = YEAR.match(text)
+    if not match or not (match.group(1) or match.group(3)):
+        raise QueryError(f"'{text}' is not a year or range of years, "
+                         "such as 1950 or 1950..1960")
+    first = int(match.group(1)) if match.group(1) else None
+    last = int(match.group(3)) if match.group(3) else None
+    if not match.group(2):
+        last = first
+    if first is not None and last is not None and first > last:
+        raise QueryError(f"the range {text} ends before it starts")
+    return first, last
+
+
+def parse_query(text):
+    """
+    Return the terms of a query, raising QueryError if it is not valid
+    """
+    # only double quotes group words, so titles like o'brien still work
+    lexer = shlex.shlex(text, posix=True)
+    lexer.quotes = '"'
+    lexer.whitespace_split = True
+    lexer.commenters = ''
+    try:
+        words = list(lexer)
+    except ValueError:
+        raise QueryError("a quoted value is missing its closing quote") \
+            from None
+    terms = []
+    for word in words:
+        field, colon, value = word.partition(':')
+        if not colon:
+            field, value = 'title', word
+        field = field.lower()
+        if field not in FIELDS:
+            raise QueryError(f"unknown field '{field}', use one of "
+                             f"{', '.join(FIELDS)}")
+        if not value:
+            raise QueryError(f"{field}: needs a value")
+        if field == 'year':
+            terms.append(Term(field, parse_year(value)))
+        else:
+            terms.append(Term(field, value))
+    if not terms:
+        raise QueryError("the query is empty")
+    return terms
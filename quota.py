@@ -0,0 +1,166 @@
+"""
+Rate limiting and retries for calls to Google APIs.
+
+Every call to Google Sheets or Google Books first takes a token from a
+token bucket, so book-worm stays under the per-minute quota instead of
+running into it. Calls that still fail with a rate limit (429) or server
+error (5xx) are retried with exponential backoff and jitter, waiting at
+least as long as a Retry-After header on the response asks. The time
+spent waiting on each bucket and the number of retries are kept in
+STATS so callers can see how much the limits cost them.
+
+The limits are read from these environment variables:
+
+    BOOKWORM_SHEETS_READS_PER_MINUTE   (default 60)
+    BOOKWORM_SHEETS_WRITES_PER_MINUTE  (default 60)
+    BOOKWORM_BOOKS_REQUESTS_PER_MINUTE (default 100)
+    BOOKWORM_MAX_RETRIES               (default 5)
+"""
+import os
+import random
+import threading
+import time
+
+# status codes worth retrying: rate limited or a temporary server error
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# status codes that mean a write was not applied, so it is safe to send
+# again; other server errors may have been applied already
+WRITE_RETRY_STATUSES = {429, 503}
+
+
+class TokenBucket:
+    """
+    Allows rate calls per minute on average, with bursts of up to capacity
+    calls. acquire() blocks until a token is free and returns how long it
+    waited; the total is kept in waited.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.rate = rate / 60
+        self.capacity = capacity or max(1, rate // 6)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Take a token, waiting for one if the bucket is empty
+        """
+        start = self.clock()
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    waited = self.updated - start
+                    self.waited += waited
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            self.sleep(delay)
+
+
+def backoff_delays(retries, base=1.0, cap=32.0, rng=random.random):
+    """
+    Yield retries delays growing exponentially from base up to cap, each
+    with full jitter
+    """
+    for attempt in range(retries):
+        yield rng() * min(cap, base * 2 ** attempt)
+
+
+def retry_after(error):
+    """
+    Return the seconds the Retry-After header of the response an error
+    was raised for asks to wait, or 0 if there is none
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return max(0.0, float(headers.get('Retry-After', 0)))
+    except ValueError:
+        # an HTTP date rather than seconds
+        return 0.0
+
+
+def call_with_retry(func, should_retry, bucket=None, retries=None,
+                    sleep=None, stats=None):
+    """
+    Call func after taking a token from bucket. If it raises an exception
+    for which should_retry returns True, wait with exponential backoff and
+    jitter, or as long as the response's Retry-After asks if that is
+    longer, and try again, up to retries times, before letting it through.
+    """
+    if retries is None:
+        retries = int(os.environ.get('BOOKWORM_MAX_RETRIES', 5))
+    sleep = sleep or time.sleep
+    stats = stats if stats is not None else STATS
+    delays = backoff_delays(retries)
+    while True:
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            return func()
+        except Exception as error:  # pylint: disable=broad-except
+            if not should_retry(error):
+                raise
+            delay = next(delays, None)
+            if delay is None:
+                raise
+            delay = max(delay, retry_after(error))
+            stats.record_retry(delay)
+            sleep(delay)
+
+
+class QuotaStats:
+    """
+    Time spent waiting on the limiters and on backoff between retries
+    """
+
+    def __init__(self):
+        self.retries = 0
+        self.backoff = 0.0
+        self.lock = threading.Lock()
+
+    def record_retry(self, delay):
+        """
+        Count a retry that waits delay seconds first
+        """
+        with self.lock:
+            self.retries += 1
+            self.backoff += delay
+
+    def snapshot(self):
+        """
+        Return the waiting time so far as a dict
+        """
+        return {
+            'sheets_read_wait': SHEETS_READS.waited,
+            'sheets_write_wait': SHEETS_WRITES.waited,
+            'books_wait': BOOKS_REQUESTS.waited,
+            'retries': self.retries,
+            'backoff_wait': self.backoff,
+        }
+
+
+def _per_minute(variable, default):
+    return int(os.environ.get(variable, default))
+
+
+SHEETS_READS = TokenBucket(
+    _per_minute('BOOKWORM_SHEETS_READS_PER_MINUTE', 60))
+SHEETS_WRITES = TokenBucket(
+    _per_minute('BOOKWORM_SHEETS_WRITES_PER_MINUTE', 60))
+BOOKS_REQUESTS = TokenBucket(
+    _per_minute('BOOKWORM_BOOKS_REQUESTS_PER_MINUTE', 100))
+STATS = QuotaStats()
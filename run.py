@@ -1,47 +1,74 @@
 """import required libraries"""
+import os
 import time
 import getpass
+import threading
 import requests
-import gspread
-from google.oauth2.service_account import Credentials
 from termcolor import cprint
-from inquirer import prompt, List
+from inquirer import prompt, Checkbox, List
 from inquirer.themes import GreenPassion
 from tabulate import tabulate
 import argon2
-from gspread.exceptions import APIError
-from googleapiclient.errors import HttpError
-
-# define scope
-SCOPE = [
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive.file",
-    "https://www.googleapis.com/auth/drive"
-    ]
+import metrics
+from library import Library
+from paging import Pager, prefetcher
+from offline import open_offline_library
+from write_behind import (
+    WriteBehindLibrary, describe_lost, open_write_behind_library
+)
+from hashing import make_password_hasher
+from books_api import lookup_isbn
+from isbn_cache import normalise_isbn, is_valid_isbn
+from isbn_import import read_isbns, resolve_isbns, write_report
+from query import QueryError, parse_query
+from storage import LazyStorage, StorageError, UserExistsError
+
+# the storage backend chosen by BOOKWORM_STORAGE (Google Sheets by
+# default), opened in the background on first use or when started
+STORAGE = LazyStorage()
+
+
+class Session(threading.local):
+    """
+    The logged in user, their library and the background thread that
+    writes its changes: the syncer of its offline journal when
+    BOOKWORM_OFFLINE is set, or else its write-behind writer, and a notice
+    to show on the main menu, and the executor that prefetches pages of
+    books. Every thread has its own, so that server.py can run many
+    sessions at once.
+    """
+    username = None
+    library = None
+    syncer = None
+    notice = None
+    prefetcher = None
 
-# add credentials to the account
-CREDS = Credentials.from_service_account_file('creds.json')
-SCOPED_CREDS = CREDS.with_scopes(SCOPE)
 
-# authorize the clientsheet
-CLIENT = gspread.authorize(SCOPED_CREDS)
+SESSION = Session()
 
-# get the instance of the Spreadsheet
-MAIN_SHEET = CLIENT.open('book_worm')
+# libraries open in some session, shared by every session of the same user
+# as [library, syncer, number of sessions]
+LIBRARIES = {}
+LIBRARIES_LOCK = threading.Lock()
 
-# Initialize the Argon2 password hasher
-password_hasher = argon2.PasswordHasher()
+# a lock per user held while their library is opened, so that a slow open
+# only holds up other logins of the same user
+OPENING_LOCKS = {}
+
+# most lost changes listed after a write fails in the background
+MAX_LOST_SHOWN = 20
+
+# Initialize the Argon2 password hasher with the configured parameters
+password_hasher = make_password_hasher()
 
 
 # Create a new user account
+@metrics.action
 def create_user():
     """
-    Create a new user account with a new sheet in CLIENT and add the user's
-    username and hashed password to the 'users' sheet.
+    Create a new user account with a new library in STORAGE and add the
+    user's username and hashed password to the users list.
     """
-    # Get the 'users' sheet
-    users_sheet = CLIENT.open('book_worm').worksheet('users')
-
     # Get the new user's information
     try:
         while True:
@@ -56,6 +83,15 @@ def create_user():
                       " Please try again.")
                 time.sleep(2)
                 continue
+            try:
+                if STORAGE.user_exists(username):
+                    print("That username is taken. Please try again.")
+                    time.sleep(2)
+                    continue
+            except StorageError as error:
+                print(f"An error occurred: {error}")
+                time.sleep(2)
+                return
             password = None
             confirm_password = None
             while (password is None or confirm_password is None or
@@ -82,38 +118,31 @@ def create_user():
     # Hash the password using Argon2
     hashed_password = password_hasher.hash(password)
 
-    # Try to create a new sheet for the user
+    # Try to create a new library for the user and add the user's
+    # information to the users list in a single write
     try:
-        new_sheet = MAIN_SHEET.add_worksheet(
-            title=username, rows="100", cols="20")
-        new_sheet.update('A1', 'Title')
-        new_sheet.update('B1', 'Author')
-        new_sheet.update('C1', 'Year Published')
-        new_sheet.update('D1', 'Genre')
-    except APIError:
-        print("Error: a sheet with that name already exists")
+        STORAGE.create_user(username, hashed_password)
+    except UserExistsError as error:
+        print(f"Error: {error}")
         time.sleep(2)
         return
-    except HttpError as error:
+    except StorageError as error:
         print(f"An error occurred: {error}")
         time.sleep(2)
         return
 
-    # Add the user's information to the 'users' sheet
-    users_sheet.append_row([username, hashed_password])
     print("User account created successfully!")
     time.sleep(2)
     return
 
 
+@metrics.action
 def login():
     """
-    Log in to an existing user account and set SHEET as their sheet in
-    book_worm.
+    Log in to an existing user account and open their library as the
+    session's library cache, which loads their books the first time they
+    are needed.
     """
-    # Get the 'users' sheet
-    users_sheet = CLIENT.open('book_worm').worksheet('users')
-
     print("\033[2J\033[H")
     cprint("LOGIN TO YOUR LIBRARY", "green", attrs=["bold"])
     print(" ")
@@ -126,30 +155,36 @@ def login():
     except KeyboardInterrupt:
         return "Q"
 
-    # Try to find the user's information in the 'users' sheet
-    user_cell = users_sheet.find(username)
-    if not user_cell:
+    # Try to find the user's password hash in the users list
+    try:
+        password_hash = STORAGE.get_password_hash(username)
+    except StorageError:
+        print("Error: unable to access the users list")
+        return False
+    if not password_hash:
         print("Error: username not found")
         return False
 
-    # Get the row and column indices of the user's information
-    row_index = user_cell.row
-    password_col = user_cell.col + 1
-
     # Check the password using Argon2
-    password_hash = users_sheet.cell(row_index, password_col).value
-
     try:
         password_hasher.verify(password_hash, password)
     except (ValueError, argon2.exceptions.VerifyMismatchError):
         print("Error: incorrect password")
         return False
 
-    # Set SHEET as the user's sheet in book_worm
+    # Upgrade hashes made with outdated parameters while we know the
+    # password; a failure here must not stop the user logging in
+    if password_hasher.check_needs_rehash(password_hash):
+        try:
+            STORAGE.set_password_hash(
+                username, password_hasher.hash(password))
+        except StorageError:
+            pass
+
+    # Open the user's library for this session
     try:
-        global SHEET
-        SHEET = CLIENT.open('book_worm').worksheet(username)
-    except APIError:
+        open_user_library(username)
+    except StorageError:
         print("Error: unable to access the user's sheet")
         return False
 
@@ -158,6 +193,60 @@ def login():
     return True
 
 
+def open_user_library(username):
+    """
+    Open the user's library as the session's library, through the offline
+    journal if offline mode is on and otherwise with its writes sent in
+    the background. A library already open in another session of the same
+    user is shared rather than opened again.
+    """
+    with LIBRARIES_LOCK:
+        opening = OPENING_LOCKS.setdefault(username, threading.Lock())
+    with opening:
+        with LIBRARIES_LOCK:
+            entry = LIBRARIES.get(username)
+            if entry is not None:
+                entry[2] += 1
+        if entry is None:
+            store = STORAGE.open_library(username)
+            if os.environ.get('BOOKWORM_OFFLINE'):
+                store, syncer = open_offline_library(store, username)
+            else:
+                store, syncer = open_write_behind_library(store)
+            entry = [Library(store), syncer, 1]
+            with LIBRARIES_LOCK:
+                LIBRARIES[username] = entry
+    SESSION.username = username
+    SESSION.library, SESSION.syncer = entry[:2]
+
+
+def logout():
+    """
+    Close the session's library. Once no session of the user has it open
+    its syncer or writer is stopped after a last attempt to write. Returns
+    the number of changes still waiting, which in offline mode sync the
+    next time the user logs in. Pages still being prefetched are dropped.
+    """
+    if SESSION.prefetcher is not None:
+        SESSION.prefetcher.shutdown(wait=False, cancel_futures=True)
+        SESSION.prefetcher = None
+    if SESSION.username is None:
+        return 0
+    with LIBRARIES_LOCK:
+        entry = LIBRARIES[SESSION.username]
+        entry[2] -= 1
+        if entry[2] == 0:
+            del LIBRARIES[SESSION.username]
+    syncer = SESSION.syncer
+    SESSION.username = SESSION.library = SESSION.syncer = None
+    if syncer is None:
+        return 0
+    if entry[2] == 0:
+        return syncer.stop()
+    syncer.notify()
+    return syncer.library.pending_count
+
+
 # define the main menu function
 def main_menu():
     """
@@ -166,6 +255,12 @@ def main_menu():
     print("\033[2J\033[H")
     cprint("Welcome to BookWorm!", "yellow")
     print(" ")
+    if SESSION.notice:
+        cprint(SESSION.notice, "green")
+        print(" ")
+        SESSION.notice = None
+    if SESSION.syncer:
+        report_sync_status()
 
     questions = [
         List('choice',
@@ -175,6 +270,7 @@ def main_menu():
                       ('Update a book', '3'),
                       ('Search for a book', '4'),
                       ('Display all books', '5'),
+                      ('Library statistics', '7'),
                       ('Quit', '6')
                       ]
              ),
@@ -184,7 +280,73 @@ def main_menu():
     return choice['choice']
 
 
+def report_sync_status():
+    """
+    Show how many changes are waiting to be written, and reload the library
+    if any of them failed or conflicted with changes made elsewhere
+    """
+    store = SESSION.syncer.library
+    if isinstance(store, WriteBehindLibrary):
+        report_write_status(store)
+        return
+    if store.conflicts:
+        cprint(f"{len(store.conflicts)} offline changes conflicted with "
+               "changes made elsewhere and were not applied. They are "
+               f"listed in {store.journal.conflicts_path}", "red")
+        store.conflicts.clear()
+        reload_library()
+    if store.pending_count:
+        cprint(f"{store.pending_count} changes waiting to sync", "yellow")
+        print(" ")
+
+
+def reload_library():
+    """
+    Load the session's library again from the storage backend and return
+    the titles of its books, or None if it cannot be read right now, in
+    which case it is loaded the next time it is used
+    """
+    try:
+        SESSION.library.load()
+        return [book.title for book in
+                SESSION.library.get_range(0, SESSION.library.count())]
+    except StorageError as error:
+        cprint(f"Unable to reload your library: {error}", "red")
+        SESSION.library.unload()
+        return None
+
+
+def report_write_status(store):
+    """
+    Report writes that failed in the background since the main menu was
+    last shown, listing the changes that were lost so they can be made
+    again, after reloading the library without them. Also show how many
+    changes are still being written.
+    """
+    failures = store.take_failures()
+    if failures:
+        titles = reload_library()
+    for error, lost in failures:
+        descriptions = describe_lost(lost, titles)
+        cprint(f"{len(descriptions)} changes could not be saved: {error}",
+               "red")
+        for description in descriptions[:MAX_LOST_SHOWN]:
+            cprint(f"  {description}", "red")
+        if len(descriptions) > MAX_LOST_SHOWN:
+            cprint(f"  and {len(descriptions) - MAX_LOST_SHOWN} more",
+                   "red")
+        # later failures were queued after these changes
+        titles = None
+    if failures:
+        cprint("Please make these changes again.", "red")
+    if store.pending_count:
+        cprint(f"{store.pending_count} changes being saved", "yellow")
+    if failures or store.pending_count:
+        print(" ")
+
+
 # define the add_book function
+@metrics.action
 def add_book():
     """
     Add new book to database
@@ -195,7 +357,8 @@ def add_book():
         print(" ")
         cprint("PRESS CTRL+C TO RETURN TO MAIN MENU", "green", attrs=["bold"])
         print("Enter the book details below:")
-        fields = ["Title", "Author", "Year (optional)", "Genre"]
+        fields = ["Title", "Author", "Year (optional)", "Genre",
+                  "ISBN (optional)"]
         book = []
 
         for i, field in enumerate(fields):
@@ -203,9 +366,14 @@ def add_book():
                 value = input(f"{field}: ")
                 if i == 2 and value and not value.isdigit():
                     print("Invalid year. Please enter digits only.")
-                elif i == 2 and value == "":
+                elif i in [2, 4] and value == "":
                     book.append("")
                     break
+                elif i == 4 and not is_valid_isbn(value):
+                    print("Invalid ISBN. Please enter a 10 or 13 digit ISBN.")
+                elif i == 4:
+                    book.append(normalise_isbn(value))
+                    break
                 elif i in [1, 3] and value == "":
                     while True:
                         choice = input(
@@ -232,12 +400,11 @@ def add_book():
                     )
         # add the book to the sheet
         try:
-            SHEET.append_row(book)
-        except gspread.exceptions.APIError:
+            SESSION.library.append(book)
+        except StorageError:
             print("Error adding book. Please try again.")
             return
         print("Book added successfully!")
-        time.sleep(2)
 
         # ask user if they want to add another book
         while True:
@@ -253,14 +420,21 @@ def add_book():
 
 
 # define add_book_isbn function
+@metrics.action
 def add_book_isbn():
     """
     Look up book details using an ISBN and add the book to the database
     """
+    added = None
     while True:
         print("\033[2J\033[H")
         cprint("ADD BOOK BY ISBN", "green", attrs=["bold"])
         print("Press Ctrl+C at any time to cancel.\n")
+        if added:
+            # the book is saved in the background, so there is no need to
+            # wait before asking for the next one
+            print(f"{added} added successfully!\n")
+            added = None
 
         try:
             isbn = input("Enter the book's ISBN: ")
@@ -270,17 +444,10 @@ def add_book_isbn():
                 continue
 
             # Call Google Books API to retrieve book details
-            url = f"https://www.googleapis.com/books/v1/volumes?q=isbn:{isbn}"
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-
-            book_data = response.json()["items"][0]["volumeInfo"]
-
-            # Extract book information from the API response
-            title = book_data["title"]
-            authors = ", ".join(book_data.get("authors", ["Unknown"]))
-            year = book_data.get("publishedDate", "Unknown")[:4]
-            genres = ", ".join(book_data.get("categories", ["Unknown"]))
+            book = lookup_isbn(isbn)
+            if book is None:
+                raise KeyError(isbn)
+            title, authors, year, genres = book
 
             # Print out the information
             print(f"\nTitle: {title}")
@@ -295,11 +462,9 @@ def add_book_isbn():
                     return
                 elif choice.lower() == 'y':
                     # Add the book to the sheet
-                    SHEET.append_row([title, authors, year, genres])
-
-                    # Print out the success message
-                    print(f"\n{title} by {authors} added successfully!")
-                    time.sleep(2)
+                    SESSION.library.append(book + [normalise_isbn(isbn)])
+                    added = f"{title} by {authors}"
+                    break
                 else:
                     cprint("Invalid choice. Please enter 'y' or 'n'.", "red")
         except KeyboardInterrupt:
@@ -316,6 +481,58 @@ def add_book_isbn():
             continue
 
 
+@metrics.action
+def import_isbn_file():
+    """
+    Read a file of ISBNs, look them all up concurrently and add every book
+    that was found to the database in bulk
+    """
+    print("\033[2J\033[H")
+    cprint("IMPORT BOOKS FROM AN ISBN FILE", "green", attrs=["bold"])
+    print("A text file with one ISBN per line, or a CSV file with the ISBN")
+    print("in the first column. Press Ctrl+C at any time to cancel.\n")
+
+    try:
+        path = input("Enter the path of the file: ").strip()
+        if not path:
+            return
+        try:
+            isbns = read_isbns(path)
+        except OSError as error:
+            print(f"Unable to read {path}: {error.strerror}")
+            input("Press Enter to continue.")
+            return
+        if not isbns:
+            print("No ISBNs found in the file.")
+            input("Press Enter to continue.")
+            return
+
+        print(f"Looking up {len(isbns)} ISBNs...")
+        result = resolve_isbns(
+            isbns,
+            progress=lambda done, total: print(
+                f"\r{done}/{total} looked up", end="", flush=True))
+        print(f"\nAdding {len(result.books)} books to the database...")
+        try:
+            SESSION.library.extend(result.books)
+        except StorageError as error:
+            print(f"Error adding books: {error}")
+            input("Press Enter to continue.")
+            return
+    except KeyboardInterrupt:
+        print("\nImport cancelled.")
+        time.sleep(2)
+        return
+
+    print(f"{len(result.books)} books added successfully!")
+    if result.not_found or result.failed:
+        report = write_report(path, result)
+        print(f"{len(result.not_found)} ISBNs were not found and "
+              f"{len(result.failed)} could not be looked up.")
+        print(f"The ISBNs are listed in {report}")
+    input("Press Enter to continue.")
+
+
 def add_book_menu():
     """
     Display the add book menu and prompt user for choice
@@ -332,6 +549,7 @@ def add_book_menu():
                 choices=[
                     ("Add book manually", "1"),
                     ("Look up book by ISBN", "2"),
+                    ("Import ISBNs from a file", "3"),
                     ("Back", "q")
                 ],
             ),
@@ -344,6 +562,9 @@ def add_book_menu():
         elif choice == '2':
             add_book_isbn()
             return
+        elif choice == '3':
+            import_isbn_file()
+            return
         elif choice == 'q':
             return
         else:
@@ -351,6 +572,7 @@ def add_book_menu():
             time.sleep(2)
 
 
+@metrics.action
 def remove_book():
     """
     Remove book from database
@@ -363,13 +585,18 @@ def remove_book():
             cprint("PRESS CTRL+C TO RETURN TO MAIN MENU", "green",
                    attrs=["bold"])
             title = input("Enter the title of the book you want to remove\n")
+            # find the book in the library
+            book_id = SESSION.library.find_title(title)
+            if book_id is None:
+                book_id = choose_close_title(title)
+            if book_id is None:
+                print("The book is not in the database. Please try again.")
+                time.sleep(2)
+                continue
             try:
-                # find the book in the sheet
-                cell = SHEET.find(title)
                 # remove the book from the sheet
-                SHEET.delete_rows(cell.row)
+                SESSION.library.delete(book_id)
                 print("Book removed successfully!")
-                time.sleep(2)
 
                 # ask user if they want to remove another book
                 while True:
@@ -384,16 +611,39 @@ def remove_book():
                         cprint(
                             "Invalid choice. Please enter 'y' or 'n'.",
                             "red")
-            except gspread.exceptions.CellNotFound:
-                print("The book is not in the database. Please try again.")
+            except StorageError:
+                print("Error removing book. Please try again.")
                 time.sleep(2)
     except KeyboardInterrupt:
         print("Remove book operation canceled.")
 
 
+def choose_close_title(title):
+    """
+    Offer a shortlist of the books whose titles are closest to a title
+    that matched no book exactly, and return the id of the one the user
+    picks, or None
+    """
+    book_ids = SESSION.library.closest_titles(title)
+    if not book_ids:
+        return None
+    choices = []
+    for book_id in book_ids:
+        book = SESSION.library.get(book_id)
+        choices.append((f"{book.title} by {book.author}", book_id))
+    choices.append(("None of these", None))
+    answer = prompt([
+        List('book',
+             message=f"No book is titled '{title}'. Did you mean",
+             choices=choices, default=book_ids[0]),
+    ], theme=GreenPassion())
+    return answer['book']
+
+
+@metrics.action
 def remove_book_isbn():
     """
-    Look up book details using an ISBN and remove the book from the database
+    Find a book by its ISBN in the database and remove it
     """
     while True:
         try:
@@ -404,24 +654,19 @@ def remove_book_isbn():
             isbn = input("Enter the book's ISBN: ")
             if not isbn:
                 continue
-            # Call Google Books API to retrieve book details
-            url = f"https://www.googleapis.com/books/v1/volumes?q=isbn:{isbn}"
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-
-            book_data = response.json()["items"][0]["volumeInfo"]
-
-            # Extract book information from the API response
-            title = book_data["title"]
-
-            # Search for the book in the sheet and remove it
-            sheet = SHEET.get_all_values()
-            for row in sheet:
-                if title == row[0]:
-                    SHEET.delete_rows(sheet.index(row) + 1)
-                    break
+            if not is_valid_isbn(isbn):
+                raise KeyError(isbn)
+
+            # Search for the book in the library by its ISBN
+            book_id = SESSION.library.find_isbn(isbn)
+            if book_id is None:
+                book_id = find_legacy_isbn(isbn)
+            if book_id is None:
+                print(f"No book with ISBN {isbn} is in the database.")
+                time.sleep(2)
+                continue
+            SESSION.library.delete(book_id)
             print("Book removed successfully!")
-            time.sleep(2)
 
             # ask user if they want to add another book
             while True:
@@ -447,6 +692,81 @@ def remove_book_isbn():
             return
 
 
+def find_legacy_isbn(isbn):
+    """
+    Find a book added before ISBNs were stored by looking up its title,
+    only matching books that have no ISBN recorded
+    """
+    book = lookup_isbn(isbn)
+    if book is None:
+        return None
+    return SESSION.library.find_untagged_title(book[0])
+
+
+@metrics.action
+def remove_books_bulk():
+    """
+    Let the user tick any number of books, from the whole library or the
+    results of a search query, and remove them all with a single write
+    """
+    try:
+        print("\033[2J\033[H")
+        cprint("REMOVE SEVERAL BOOKS", "green", attrs=["bold"])
+        print(" ")
+        cprint("PRESS CTRL+C TO RETURN TO MAIN MENU", "green", attrs=["bold"])
+        print("Enter a search query to choose from its results, for example")
+        print("author:tolkien year:..1960, or just hit enter to choose from")
+        print("the whole library.")
+        text = input("Query: ").strip()
+        if text:
+            try:
+                book_ids = SESSION.library.query_ids(parse_query(text))
+            except QueryError as error:
+                print(f"Invalid query: {error}")
+                time.sleep(2)
+                return
+        else:
+            book_ids = SESSION.library.book_ids()
+        if not book_ids:
+            print("No books to remove.")
+            time.sleep(2)
+            return
+
+        choices = []
+        for book_id in book_ids:
+            book = SESSION.library.get(book_id)
+            choices.append(
+                (f"{book.title} by {book.author} ({book.year})", book_id))
+        selected = prompt([
+            Checkbox('books',
+                     message="Select the books to remove (space to select, "
+                             "enter when done)",
+                     choices=choices),
+        ], theme=GreenPassion())['books']
+        if not selected:
+            print("No books selected.")
+            time.sleep(2)
+            return
+
+        while True:
+            choice = input(f"Remove {len(selected)} books? (y/n): ")
+            if choice.lower() == 'n':
+                return
+            elif choice.lower() == 'y':
+                break
+            else:
+                cprint("Invalid choice. Please enter 'y' or 'n'.", "red")
+        try:
+            SESSION.library.delete_many(selected)
+        except StorageError:
+            print("Error removing books. Please try again.")
+            time.sleep(2)
+            return
+        SESSION.notice = f"{len(selected)} books removed successfully!"
+    except KeyboardInterrupt:
+        print("Remove books operation canceled.")
+
+
 def remove_book_menu():
     """
     Display the remove book menu and prompt user for choice
@@ -463,6 +783,7 @@ def remove_book_menu():
                 choices=[
                     ("Remove by title", "1"),
                     ("Remove by ISBN", "2"),
+                    ("Remove several books", "3"),
                     ("Back", "q")
                 ],
             ),
@@ -475,14 +796,18 @@ def remove_book_menu():
         elif choice == '2':
             remove_book_isbn()
             return
+        elif choice == '3':
+            remove_books_bulk()
+            return
         elif choice == 'q':
             return
         else:
-            print("Invalid choice. Please enter 1 or 2.")
+            print("Invalid choice. Please enter 1, 2 or 3.")
             time.sleep(2)
 
 
 # define the update_book function
+@metrics.action
 def update_book():
     """
     Update existing book in database
@@ -490,17 +815,20 @@ def update_book():
     while True:
         print("\033[2J\033[H")
         cprint("UPDATE BOOK IN DATABASE", "green", attrs=["bold"])
-        title = input("Enter the title of the book you want to update\n"
-                      " (q to return to main menu): ")
+        title = input("Enter the title or ISBN of the book you want to update"
+                      "\n (q to return to main menu): ")
         if title == 'q':
             return
-        try:
-            cell = SHEET.find(title)
-            book_values = SHEET.row_values(cell.row)
-        except AttributeError:
+        book_id = SESSION.library.find_title(title)
+        if book_id is None and is_valid_isbn(title):
+            book_id = SESSION.library.find_isbn(title)
+        if book_id is None:
+            book_id = choose_close_title(title)
+        if book_id is None:
             print(f"The book '{title}' was not found in the database.")
             time.sleep(2)
             continue
+        book_values = SESSION.library.get(book_id)
 
         book_fields = ["Title", "Author", "Year", "Genre"]
 
@@ -521,10 +849,9 @@ def update_book():
                 else:
                     book_update.append(value)
                     break
-        for i, field in enumerate(book_fields):
-            SHEET.update_cell(cell.row, i+1, book_update[i])
-        print("Book updated successfully!")
-        time.sleep(2)
+        # keep the ISBN of the edition being updated
+        SESSION.library.update(book_id, book_update + [book_values.isbn])
+        SESSION.notice = "Book updated successfully!"
         return
 
 
@@ -532,21 +859,20 @@ def display_search(matching_books):
     """
     Display books in a formatted manner
     """
-    page_size = 5
+    pager = Pager(lambda start, stop: matching_books[start:stop],
+                  len(matching_books), 5)
     page_number = 0
-    num_pages = (len(matching_books) + page_size - 1) // page_size
 
     while True:
         print("\033[2J\033[H")
         cprint("SEARCH RESULTS FROM DATABASE", "green", attrs=["bold"])
-        start_index = page_number * page_size
-        end_index = min(start_index + page_size, len(matching_books))
-        page_books = matching_books[start_index:end_index]
-
-        data = [[book['title'],
-                 book['author'],
-                 book['genre'],
-                 book['year']
+        page_number, page_books = pager.page(page_number)
+        num_pages = pager.total_pages
+
+        data = [[book.title,
+                 book.author,
+                 book.genre,
+                 book.year
                  ] for book in page_books]
         headers = ['Title', 'Author', 'Genre', 'Year']
         print(tabulate(
@@ -579,6 +905,7 @@ def display_search(matching_books):
             return
 
 
+@metrics.action
 def search_books_by_title(title):
     """
     Search for books in the database by title
@@ -586,15 +913,7 @@ def search_books_by_title(title):
     if title == '':
         return
     else:
-        matching_books = []
-        for row in SHEET.get_all_records():
-            if title.lower() in row['Title'].lower():
-                matching_books.append({
-                    'title': row['Title'],
-                    'author': row['Author'],
-                    'genre': row['Genre'],
-                    'year': row['Year Published']
-                })
+        matching_books = SESSION.library.search('Title', title)
         if matching_books:
             display_search(matching_books)
         else:
@@ -602,6 +921,7 @@ def search_books_by_title(title):
             time.sleep(2)
 
 
+@metrics.action
 def search_books_by_author(author):
     """
     Search for books in the database by author name
@@ -609,15 +929,7 @@ def search_books_by_author(author):
     if author == '':
         return
     else:
-        matching_books = []
-        for row in SHEET.get_all_records():
-            if author.lower() in row['Author'].lower():
-                matching_books.append({
-                    'title': row['Title'],
-                    'author': row['Author'],
-                    'genre': row['Genre'],
-                    'year': row['Year Published']
-                })
+        matching_books = SESSION.library.search('Author', author)
         if matching_books:
             display_search(matching_books)
         else:
@@ -625,6 +937,7 @@ def search_books_by_author(author):
             time.sleep(2)
 
 
+@metrics.action
 def search_books_by_genre(genre):
     """
     Display books in the database that match the given genre
@@ -632,15 +945,7 @@ def search_books_by_genre(genre):
     if genre == '':
         return
     else:
-        matching_books = []
-        for row in SHEET.get_all_records():
-            if genre.lower() in row['Genre'].lower():
-                matching_books.append({
-                    'title': row['Title'],
-                    'author': row['Author'],
-                    'genre': row['Genre'],
-                    'year': row['Year Published']
-                })
+        matching_books = SESSION.library.search('Genre', genre)
         if matching_books:
             display_search(matching_books)
         else:
@@ -648,9 +953,30 @@ def search_books_by_genre(genre):
             time.sleep(2)
 
 
+@metrics.action
+def search_books_by_query(text):
+    """
+    Search for books in the database with a query such as
+    author:tolkien genre:fantasy year:1950..1960
+    """
+    try:
+        terms = parse_query(text)
+    except QueryError as error:
+        print(f"Invalid query: {error}")
+        time.sleep(2)
+        return
+    matching_books = SESSION.library.query(terms)
+    if matching_books:
+        display_search(matching_books)
+    else:
+        print(f"No books found matching {text}.")
+        time.sleep(2)
+
+
 def search_menu():
     """
-    Displays a search menu with options to search for books by author or genre
+    Displays a search menu with options to search for books by title,
+    author or genre, or with a query
     Returns:
         str: The user's choice as a string.
     """
@@ -665,6 +991,7 @@ def search_menu():
                     ("Search by Title", "1"),
                     ("Search by Author", "2"),
                     ("Search by Genre", "3"),
+                    ("Search with a query", "4"),
                     ("Back", "q")
                 ],
             ),
@@ -708,6 +1035,18 @@ def search_choice():
                 search_books_by_genre(genre)
                 continue
 
+        elif choice == '4':
+            print("Combine title:, author:, genre: and year: terms, for "
+                  "example")
+            print('author:tolkien genre:fantasy year:1950..1960')
+            text = input("Enter the query"
+                         " (just hit enter to go back): ")
+            if text == "":
+                continue
+            else:
+                search_books_by_query(text)
+                continue
+
         elif choice == 'q':
             time.sleep(1)
             return
@@ -717,58 +1056,97 @@ def search_choice():
 
 
 # define the display_books function
+@metrics.action
 def display_books():
     """
-    Display books in the database, 6 books per page with navigation controls
+    Display books in the database, 6 books per page with navigation controls.
+    Until the whole library has been loaded only the page on screen is read,
+    with the pages either side prefetched in the background.
     """
-    while True:
-        print("\033[2J\033[H")
-        cprint("BOOK INVENTORY", 'green', attrs=['bold'])
+    print("\033[2J\033[H")
+    cprint("BOOK INVENTORY", 'green', attrs=['bold'])
 
-        # get all the records from the sheet
-        records = SHEET.get_all_records()
+    if not SESSION.library.loaded and SESSION.prefetcher is None:
+        SESSION.prefetcher = prefetcher()
+    pager = Pager(SESSION.library.get_range, SESSION.library.count(), 6,
+                  None if SESSION.library.loaded else SESSION.prefetcher)
+    page = 0
+    while True:
+        page, books = pager.page(page)
 
         # if no books in the database
-        if not records:
+        if not books:
             print("No books in the database.")
             input("Press Enter to continue.")
             return
 
         # format data for tabulate
-        data = [[record['Title'],
-                 record['Author'],
-                 record['Year Published'] or '',
-                 record['Genre']]
-                for record in records]
-
-        # display records in pages of 6
-        page = 1
-        total_pages = (len(records) + 5) // 6
-        while page <= total_pages:
-            start = (page - 1) * 6
-            end = start + 6
-            print("\033[2J\033[H")
-            cprint("BOOK INVENTORY", 'green', attrs=['bold'])
-            print(tabulate(data[start:end],
-                           headers=['Title', 'Author', 'Year', 'Genre'],
-                           tablefmt='fancy_grid',
-                           maxcolwidths=20
-                           ))
-            print(f"Page {page} of {total_pages}")
-            choices = [
-                List('action',
-                     message="Choose an action",
-                     choices=['Next page', 'Previous page', 'Back'])
-            ]
-            answer = prompt(choices, theme=GreenPassion())
-            if answer['action'] == 'Next page':
-                if page < total_pages:
-                    page += 1
-            elif answer['action'] == 'Previous page':
-                if page > 1:
-                    page -= 1
-            elif answer['action'] == 'Back':
-                return
+        data = [[book.title, book.author, book.year, book.genre]
+                for book in books]
+
+        print("\033[2J\033[H")
+        cprint("BOOK INVENTORY", 'green', attrs=['bold'])
+        print(tabulate(data,
+                       headers=['Title', 'Author', 'Year', 'Genre'],
+                       tablefmt='fancy_grid',
+                       maxcolwidths=20
+                       ))
+        print(f"Page {page + 1} of {pager.total_pages}")
+        choices = [
+            List('action',
+                 message="Choose an action",
+                 choices=['Next page', 'Previous page', 'Back'])
+        ]
+        answer = prompt(choices, theme=GreenPassion())
+        if answer['action'] == 'Next page':
+            if page < pager.total_pages - 1:
+                page += 1
+        elif answer['action'] == 'Previous page':
+            if page > 0:
+                page -= 1
+        elif answer['action'] == 'Back':
+            return
+
+
+# define the show_statistics function
+@metrics.action
+def show_statistics():
+    """
+    Show how many books there are in total and the most common genres,
+    authors and decades, from counts the library keeps up to date
+    """
+    facet = 'Genre'
+    while True:
+        print("\033[2J\033[H")
+        cprint("LIBRARY STATISTICS", 'green', attrs=['bold'])
+        print(f"{len(SESSION.library)} books, "
+              f"{SESSION.library.facet_size('Author')} authors, "
+              f"{SESSION.library.facet_size('Genre')} genres\n")
+
+        counts = SESSION.library.top(facet, 10)
+        if counts:
+            print(f"Top {len(counts)} of "
+                  f"{SESSION.library.facet_size(facet)} by "
+                  f"{facet.lower()}:")
+            print(tabulate(counts,
+                           headers=[facet, 'Books'],
+                           tablefmt='rounded_outline',
+                           maxcolwidths=[40, None]))
+        else:
+            print("No books in the database.")
+
+        choice = prompt([
+            List('facet',
+                 message="Show books by",
+                 choices=[('Genre', 'Genre'),
+                          ('Author', 'Author'),
+                          ('Decade', 'Decade'),
+                          ('Back', 'q')],
+                 default=facet),
+        ], theme=GreenPassion())['facet']
+        if choice == 'q':
+            return
+        facet = choice
 
 
 # define the main function
@@ -809,26 +1187,51 @@ def main():
 
     while True:
         choice = main_menu()
-        if choice == '1':
-            add_book_menu()
-        elif choice == '2':
-            remove_book_menu()
-        elif choice == '3':
-            update_book()
-        elif choice == '4':
-            search_choice()
-        elif choice == '5':
-            display_books()
-        elif choice == '6':
-            print("Goodbye!")
-            break
-        else:
-            print("Invalid choice. Please enter a number")
+        # the library loads on first use, so any option can hit a storage
+        # error while reading it
+        try:
+            if choice != '6':
+                # pick up changes made in other sessions since last time
+                SESSION.library.refresh()
+            if choice == '1':
+                add_book_menu()
+            elif choice == '2':
+                remove_book_menu()
+            elif choice == '3':
+                update_book()
+            elif choice == '4':
+                search_choice()
+            elif choice == '5':
+                display_books()
+            elif choice == '7':
+                show_statistics()
+            elif choice == '6':
+                offline = not isinstance(SESSION.syncer.library,
+                                         WriteBehindLibrary)
+                print("Syncing changes..." if offline else
+                      "Saving changes...")
+                pending = logout()
+                if pending and offline:
+                    print(f"{pending} changes will sync the next time "
+                          "you log in.")
+                elif pending:
+                    print(f"{pending} changes could not be saved.")
+                print("Goodbye!")
+                break
+            else:
+                print("Invalid choice. Please enter a number")
+        except StorageError as error:
+            print(f"Error: unable to access your library. {error}")
+            time.sleep(2)
 
 
-# ASCII title screen
-print("\033[2J\033[H")
-cprint(r'''
+# define the title screen function
+def title_screen():
+    """
+    Display the ASCII title screen and wait for the user to press Enter
+    """
+    print("\033[2J\033[H")
+    cprint(r'''
                         .-~~~~~~~~~-._       _.-~~~~~~~~~-.
                     __.'              ~.   .~              `.__
                 .'//                  \./                  \\`.
@@ -845,9 +1248,18 @@ cprint(r'''
                 \____/ \___/ \___/|_|\_\\/  \/ \___/|_|  |_| |_| |_|
 ''', 'green')
 
-input("Press Enter to continue...".center(80))
-print("\033[2J\033[H")
+    input("Press Enter to continue...".center(80))
+    print("\033[2J\033[H")
+
+
+if __name__ == '__main__':
+    # write a metrics snapshot on exit if BOOKWORM_METRICS is set
+    metrics.install()
 
-# call main function
+    # connect to storage in the background while the title screen waits
+    # for the user
+    STORAGE.start()
+    title_screen()
 
-main()
+    # call main function
+    main()
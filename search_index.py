@@ -0,0 +1,234 @@
+"""
+Character n-gram index for fast substring and prefix search, and a
+BK-tree for finding values within a few typos of a query
+"""
+import sys
+from collections import defaultdict
+
+# length of the n-grams kept in the index; shorter queries are answered by
+# scanning the distinct values instead
+GRAM_SIZE = 3
+
+# marks the start of a value so that prefix queries can be answered
+START = '\x02'
+
+
+def ngrams(text, size):
+    """
+    Return the set of substrings of text that are size characters long
+    """
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class NgramIndex:
+    """
+    Maps each distinct indexed value to the keys that have it, and every
+    trigram of the distinct values to the values that contain it, so a
+    value shared by many keys is only indexed once. A query is answered
+    by intersecting the postings of its trigrams, smallest first, and
+    checking the few remaining values, so it never has to look at every
+    value. Queries shorter than a trigram scan the distinct values.
+
+    Postings are plain lists, which take a fraction of the memory of sets
+    of the same values; removing a value is then linear in the postings
+    of its trigrams, which is still quick next to writing the change.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(list)
+        self.keys = {}
+        self.values = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, key, value):
+        """
+        Index value under key, replacing any value already indexed for it
+        """
+        if key in self.values:
+            self.remove(key)
+        value = sys.intern(value.lower())
+        self.values[key] = value
+        if value not in self.keys:
+            self.keys[value] = []
+            for gram in ngrams(START + value, GRAM_SIZE):
+                self.postings[gram].append(value)
+        self.keys[value].append(key)
+
+    def remove(self, key):
+        """
+        Drop key from the index
+        """
+        value = self.values.pop(key, None)
+        if value is None:
+            return
+        keys = self.keys[value]
+        keys.remove(key)
+        if keys:
+            return
+        del self.keys[value]
+        for gram in ngrams(START + value, GRAM_SIZE):
+            values = self.postings[gram]
+            values.remove(value)
+            if not values:
+                del self.postings[gram]
+
+    def _candidates(self, text):
+        """
+        Return the distinct values that contain every trigram of text, or
+        every value if text is shorter than a trigram
+        """
+        if len(text) < GRAM_SIZE:
+            return self.keys
+        postings = sorted(
+            (self.postings.get(gram, ())
+             for gram in ngrams(text, GRAM_SIZE)), key=len)
+        candidates = set(postings[0])
+        for values in postings[1:]:
+            candidates.intersection_update(values)
+            if not candidates:
+                break
+        return candidates
+
+    def _keys(self, values):
+        """
+        Return the keys of every value in values
+        """
+        found = set()
+        for value in values:
+            found.update(self.keys[value])
+        return found
+
+    def search(self, text):
+        """
+        Return the keys whose value contains text, ignoring case
+        """
+        text = text.lower()
+        if not text:
+            return set(self.values)
+        return self._keys(value for value in self._candidates(text)
+                          if text in value)
+
+    def prefix(self, text):
+        """
+        Return the keys whose value starts with text, ignoring case
+        """
+        text = text.lower()
+        return self._keys(value for value in self._candidates(START + text)
+                          if value.startswith(text))
+
+
+def edit_distance(first, second):
+    """
+    Return the Levenshtein distance between two strings: the fewest
+    single character insertions, deletions and substitutions that turn
+    one into the other. Uses Myers' bit-parallel algorithm, which works
+    through a whole column of the distance table per integer operation.
+    """
+    if len(first) < len(second):
+        first, second = second, first
+    if not second:
+        return len(first)
+    # a bit mask per character of where it occurs in the shorter string
+    masks = {}
+    for position, char in enumerate(second):
+        masks[char] = masks.get(char, 0) | 1 << position
+    full = (1 << len(second)) - 1
+    last = 1 << (len(second) - 1)
+    plus, minus, score = full, 0, len(second)
+    for char in first:
+        match = masks.get(char, 0)
+        vertical = match | minus
+        diagonal = (((match & plus) + plus) ^ plus) | match
+        up = minus | ~(diagonal | plus) & full
+        down = plus & diagonal
+        if up & last:
+            score += 1
+        elif down & last:
+            score -= 1
+        up = (up << 1 | 1) & full
+        down = (down << 1) & full
+        plus = down | ~(vertical | up) & full
+        minus = up & vertical
+    return score
+
+
+class BKNode:
+    """
+    A distinct value in a BKTree, the keys indexed with it and its children
+    by their distance from it
+    """
+    __slots__ = ('value', 'keys', 'children')
+
+    def __init__(self, value):
+        self.value = value
+        self.keys = set()
+        self.children = {}
+
+
+class BKTree:
+    """
+    Indexes values by edit distance, ignoring case. Every child of a node
+    is filed under its distance from the node, so by the triangle
+    inequality a query only has to visit the children whose distance is
+    within the tolerance of the query's own distance from the node,
+    instead of comparing the query with every value.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.nodes = {}
+        self.values = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, key, value):
+        """
+        Index value under key, replacing any value already indexed for it
+        """
+        if key in self.values:
+            self.remove(key)
+        value = value.lower()
+        self.values[key] = value
+        if value not in self.nodes:
+            node = self.nodes[value] = BKNode(value)
+            if self.root is None:
+                self.root = node
+            else:
+                parent = self.root
+                while True:
+                    distance = edit_distance(value, parent.value)
+                    if distance not in parent.children:
+                        parent.children[distance] = node
+                        break
+                    parent = parent.children[distance]
+        self.nodes[value].keys.add(key)
+
+    def remove(self, key):
+        """
+        Drop key from the index. Its node stays in the tree to keep the
+        tree's shape, and is only skipped by searches.
+        """
+        value = self.values.pop(key, None)
+        if value is not None:
+            self.nodes[value].keys.discard(key)
+
+    def search(self, text, max_distance):
+        """
+        Return (distance, key) for every key whose value is within
+        max_distance edits of text, closest first
+        """
+        text = text.lower()
+        matches = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = edit_distance(text, node.value)
+            if distance <= max_distance:
+                matches.extend((distance, key) for key in node.keys)
+            for child_distance, child in node.children.items():
+                if abs(child_distance - distance) <= max_distance:
+                    stack.append(child)
+        return sorted(matches)
@@ -0,0 +1,282 @@
+"""
+Multi-session server for book-worm.
+
+Runs the book-worm menus for many connections at once in one long-lived
+process, one thread per connection, instead of starting run.py for each
+of them. Every session shares the storage backend (one authorized Google
+client and its HTTP connections), the users directory, the ISBN cache and
+the libraries of users logged in more than once, so a new session costs
+a thread and a pseudo-terminal rather than a new interpreter that reads
+creds.json and opens the spreadsheet again.
+
+Each connection gets a pseudo-terminal of its own, which its session's
+thread uses as stdin and stdout. The bytes sent over the connection are
+what a user types and the bytes received are what the terminal shows,
+so a web terminal can be wired straight to it.
+
+The server listens on BOOKWORM_SERVER_HOST (127.0.0.1 by default) and
+BOOKWORM_SERVER_PORT (8765):
+
+    python server.py
+"""
+import fcntl
+import getpass
+import os
+import select
+import socketserver
+import struct
+import sys
+import termios
+import threading
+
+import inquirer.render.console
+from blessed import Terminal
+
+import metrics
+import run
+
+# size of every session's terminal, as the web terminal uses
+ROWS, COLS = 24, 80
+
+
+class Disconnected(BaseException):
+    """
+    Raised in a session's thread when its connection has closed. Derived
+    from BaseException so the menus cannot catch it by mistake.
+    """
+
+
+class Streams(threading.local):
+    """
+    The terminal streams of the session running on the current thread
+    """
+    stdin = None
+    stdout = None
+    terminal = None
+
+
+STREAMS = Streams()
+
+
+class StreamProxy:
+    """
+    Stands in for sys.stdin or sys.stdout, passing everything on to the
+    stream of the session running on the current thread, or to the
+    process's own stream on any other thread
+    """
+
+    def __init__(self, name, default):
+        self._name = name
+        self._default = default
+
+    def __getattr__(self, attr):
+        stream = getattr(STREAMS, self._name) or self._default
+        return getattr(stream, attr)
+
+
+class SessionInput:
+    """
+    Reads what the user types from the session's terminal. Ctrl+C ends a
+    line as well as Enter does and raises KeyboardInterrupt, as it would
+    on the user's own terminal.
+    """
+
+    encoding = 'utf-8'
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.buffer = ''
+
+    def fileno(self):
+        return self.fd
+
+    def isatty(self):
+        return True
+
+    def _fill(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError:
+            data = b''
+        if not data:
+            raise Disconnected()
+        self.buffer += data.decode('utf-8', errors='replace')
+
+    def read(self, size=-1):
+        while not self.buffer:
+            self._fill()
+        if size < 0:
+            size = len(self.buffer)
+        text, self.buffer = self.buffer[:size], self.buffer[size:]
+        return text
+
+    def readline(self, size=-1):
+        while '\n' not in self.buffer and '\x03' not in self.buffer:
+            self._fill()
+        line, newline, rest = self.buffer.partition('\n')
+        if '\x03' in line:
+            self.buffer = self.buffer.partition('\x03')[2]
+            raise KeyboardInterrupt
+        self.buffer = rest
+        return line + newline
+
+
+class SessionOutput:
+    """
+    Writes straight to the session's terminal
+    """
+
+    encoding = 'utf-8'
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def isatty(self):
+        return True
+
+    def write(self, text):
+        data = text.encode('utf-8', errors='replace')
+        try:
+            while data:
+                data = data[os.write(self.fd, data):]
+        except OSError:
+            raise Disconnected() from None
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def open_terminal():
+    """
+    Open a pseudo-terminal for a session and return its (master, slave)
+    file descriptors
+    """
+    master, slave = os.openpty()
+    fcntl.ioctl(slave, termios.TIOCSWINSZ,
+                struct.pack('HHHH', ROWS, COLS, 0, 0))
+    attributes = termios.tcgetattr(slave)
+    # no process has this terminal as its controlling terminal, so Ctrl+C
+    # is passed to the session as a character instead of a signal
+    attributes[3] &= ~termios.ISIG
+    attributes[6][termios.VEOL] = b'\x03'
+    termios.tcsetattr(slave, termios.TCSANOW, attributes)
+    return master, slave
+
+
+def session_terminal():
+    """
+    Return the blessed Terminal of the session on the current thread, which
+    inquirer draws its menus with
+    """
+    return STREAMS.terminal or Terminal()
+
+
+def session_getpass(prompt='Password: ', stream=None):
+    """
+    Read a password from the session's terminal without echoing it. The
+    standard getpass would use the server's own terminal.
+    """
+    fd = sys.stdin.fileno()
+    attributes = termios.tcgetattr(fd)
+    quiet = attributes[:]
+    quiet[3] &= ~termios.ECHO
+    termios.tcsetattr(fd, termios.TCSAFLUSH, quiet)
+    try:
+        sys.stdout.write(prompt)
+        return sys.stdin.readline().rstrip('\n')
+    finally:
+        termios.tcsetattr(fd, termios.TCSAFLUSH, attributes)
+        sys.stdout.write('\n')
+
+
+def pump(connection, master):
+    """
+    Copy bytes both ways between a connection and its session's terminal
+    until either side closes, then close the terminal
+    """
+    try:
+        while True:
+            readable = select.select([connection, master], [], [])[0]
+            if connection in readable:
+                data = connection.recv(4096)
+                if not data:
+                    break
+                os.write(master, data)
+            if master in readable:
+                data = os.read(master, 4096)
+                if not data:
+                    break
+                connection.sendall(data)
+    except OSError:
+        # the session closed its end of the terminal
+        pass
+    finally:
+        os.close(master)
+
+
+class SessionHandler(socketserver.BaseRequestHandler):
+    """
+    Runs the book-worm menus for one connection
+    """
+
+    def handle(self):
+        master, slave = open_terminal()
+        pumping = threading.Thread(target=pump, args=(self.request, master),
+                                   name='pump', daemon=True)
+        pumping.start()
+        STREAMS.stdin = SessionInput(slave)
+        STREAMS.stdout = SessionOutput(slave)
+        STREAMS.terminal = Terminal(kind='xterm-256color',
+                                    stream=STREAMS.stdout,
+                                    force_styling=True)
+        try:
+            run.title_screen()
+            run.main()
+        except (Disconnected, SystemExit, KeyboardInterrupt):
+            pass
+        finally:
+            run.logout()
+            STREAMS.stdin = STREAMS.stdout = STREAMS.terminal = None
+            os.close(slave)
+            pumping.join()
+
+
+class Server(socketserver.ThreadingTCPServer):
+    """
+    A threaded TCP server of book-worm sessions
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def main():
+    """
+    Serve sessions until interrupted, then sync every open library
+    """
+    sys.stdin = StreamProxy('stdin', sys.stdin)
+    sys.stdout = StreamProxy('stdout', sys.stdout)
+    inquirer.render.console.Terminal = session_terminal
+    getpass.getpass = session_getpass
+
+    metrics.install()
+    run.STORAGE.start()
+
+    address = (os.environ.get('BOOKWORM_SERVER_HOST', '127.0.0.1'),
+               int(os.environ.get('BOOKWORM_SERVER_PORT', 8765)))
+    with Server(address, SessionHandler) as server:
+        print(f"Serving book-worm sessions on {address[0]}:{address[1]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    for _, syncer, _ in list(run.LIBRARIES.values()):
+        if syncer:
+            syncer.stop()
+
+
+if __name__ == '__main__':
+    main()
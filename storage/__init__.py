@@ -0,0 +1,100 @@
+"""
+Storage backends for book-worm users and their libraries.
+
+Every backend implements the Storage interface for users and the
+LibraryStore interface for a single user's books, so the menus in run.py
+work the same whichever backend is in use. The backend is chosen with the
+BOOKWORM_STORAGE environment variable ('sheets' by default, or 'sqlite').
+"""
+import os
+import threading
+from concurrent.futures import Future
+
+from storage.base import (
+    HEADERS, Storage, LibraryStore, StorageError, UserExistsError,
+    BookChangedError, row_checksum
+)
+
+__all__ = [
+    'HEADERS', 'Storage', 'LibraryStore', 'StorageError', 'UserExistsError',
+    'BookChangedError', 'row_checksum', 'open_storage', 'LazyStorage'
+]
+
+
+def open_storage(backend=None):
+    """
+    Open the configured storage backend and return it
+    """
+    backend = backend or os.environ.get('BOOKWORM_STORAGE', 'sheets')
+    if backend == 'sqlite':
+        from storage.sqlite import SqliteStorage
+        return SqliteStorage(
+            os.environ.get('BOOKWORM_SQLITE_PATH', 'book_worm.db'))
+    if backend == 'sheets':
+        from storage.sheets import SheetsStorage
+        shards = os.environ.get('BOOKWORM_SHARDS', '')
+        return SheetsStorage.connect(
+            'creds.json', 'book_worm',
+            [shard.strip() for shard in shards.split(',') if shard.strip()])
+    raise StorageError(f"Unknown storage backend '{backend}'")
+
+
+class LazyStorage:
+    """
+    Stands in for the storage backend while it is opened in a background
+    thread, so that authorizing and opening the spreadsheet overlap with
+    whatever the user is doing at startup. Using any attribute waits for
+    the backend to be ready, and raises StorageError if opening it failed,
+    after which the next use opens it again. Nothing is opened until
+    start() is called or an attribute is used.
+    """
+
+    def __init__(self, opener=open_storage):
+        self._opener = opener
+        self._opening = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Begin opening the backend in a background thread, unless it is
+        already open or being opened
+        """
+        self._attempt()
+        return self
+
+    def _attempt(self):
+        """
+        Return the Future of the current attempt to open the backend,
+        starting one if there is none
+        """
+        with self._lock:
+            if self._opening is None:
+                self._opening = Future()
+                threading.Thread(
+                    target=self._open, args=(self._opening,),
+                    name='storage-connect', daemon=True).start()
+            return self._opening
+
+    def _open(self, opening):
+        try:
+            opening.set_result(self._opener())
+        # any failure is handed to the threads waiting for this attempt
+        except Exception as error:  # pylint: disable=broad-except
+            opening.set_exception(error)
+
+    def wait(self):
+        """
+        Wait for the backend to open and return it. If opening failed, the
+        failure is raised and forgotten, so the next use tries again.
+        """
+        opening = self._attempt()
+        try:
+            return opening.result()
+        except Exception as error:  # pylint: disable=broad-except
+            with self._lock:
+                if self._opening is opening:
+                    self._opening = None
+            raise StorageError(f"unable to open storage: {error}") from error
+
+    def __getattr__(self, name):
+        return getattr(self.wait(), name)
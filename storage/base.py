@@ -0,0 +1,195 @@
+"""Interfaces and errors shared by every storage backend"""
+import zlib
+
+# column headers of a user's library
+HEADERS = ['Title', 'Author', 'Year Published', 'Genre', 'ISBN']
+
+
+def row_checksum(row):
+    """
+    Return a short checksum of a book's values, padded or trimmed to one
+    per header, that changes whenever any of them does
+    """
+    values = [str(value) for value in row[:len(HEADERS)]]
+    values += [''] * (len(HEADERS) - len(values))
+    checksum = zlib.crc32('\x1f'.join(values).encode('utf-8'))
+    return f'{checksum:08x}'
+
+
+class StorageError(Exception):
+    """
+    Raised when a backend fails to read or write data
+    """
+
+
+class UserExistsError(StorageError):
+    """
+    Raised when creating a user or library whose name is already taken
+    """
+
+
+class BookChangedError(StorageError):
+    """
+    Raised when changing a book that another session has removed, or
+    moved by reloading the library, since it was looked up
+    """
+
+
+class LibraryStore:
+    """
+    The books of a single user, addressed by their 0-based position in
+    the library. Each book is a list of values in HEADERS order.
+
+    Backends that keep a revision return the library's new revision from
+    a write if the library was still at the revision given to
+    expect_revision just before it, so a cached copy that was up to date
+    can take it on rather than read the library again to see what
+    changed. Otherwise, and for other backends, writes return None.
+    """
+
+    def get_rows(self):
+        """
+        Return every book in the library
+        """
+        raise NotImplementedError
+
+    def get_revision_and_rows(self):
+        """
+        Return the current revision, or None, and every book, read
+        together. Backends override this to read both at once.
+        """
+        return self.get_revision(), self.get_rows()
+
+    def count_rows(self):
+        """
+        Return the number of books in the library. Backends may return an
+        over-estimate if counting exactly would mean reading every book.
+        """
+        return len(self.get_rows())
+
+    def get_range(self, start, stop):
+        """
+        Return the books at positions start to stop - 1. Backends override
+        this to read only those books.
+        """
+        return self.get_rows()[start:stop]
+
+    def get_ranges(self, ranges):
+        """
+        Return the books in each (start, stop) range of positions. Backends
+        override this to read them all at once.
+        """
+        return [self.get_range(start, stop) for start, stop in ranges]
+
+    def get_revision(self):
+        """
+        Return a token that changes whenever the library is written to, or
+        None if the backend cannot tell when the library has changed
+        """
+        return None
+
+    def get_checksums(self):
+        """
+        Return the current revision and the row_checksum of every book in
+        library order, read together, so that a cached copy of the library
+        can find the books that changed without reading the others.
+        Returns (None, None) if the backend does not keep checksums.
+        """
+        return None, None
+
+    def expect_revision(self, revision):
+        """
+        Set the revision a cached copy of the library is up to date with,
+        or None, for the next write to check before it is made
+        """
+
+    def append_row(self, row):
+        """
+        Add a book to the end of the library
+        """
+        raise NotImplementedError
+
+    def append_rows(self, rows):
+        """
+        Add several books to the end of the library. Backends override this
+        to write them all at once.
+        """
+        revision = None
+        for row in rows:
+            revision = self.append_row(row)
+        return revision
+
+    def delete_row(self, index):
+        """
+        Remove the book at index
+        """
+        raise NotImplementedError
+
+    def delete_rows(self, indexes):
+        """
+        Remove the books at several positions, given as they are before any
+        of them is removed. Backends override this to remove them all in
+        one write.
+        """
+        revision = None
+        for index in sorted(set(indexes), reverse=True):
+            revision = self.delete_row(index)
+        return revision
+
+    def update_row(self, index, row):
+        """
+        Replace the book at index
+        """
+        raise NotImplementedError
+
+
+class Storage:
+    """
+    User accounts and the library that belongs to each of them
+    """
+
+    def get_password_hash(self, username):
+        """
+        Return the stored password hash for username, or None if the
+        user does not exist
+        """
+        raise NotImplementedError
+
+    def user_exists(self, username):
+        """
+        Return True if a user with this name exists
+        """
+        return self.get_password_hash(username) is not None
+
+    def add_user(self, username, password_hash):
+        """
+        Record a new user and their password hash
+        """
+        raise NotImplementedError
+
+    def set_password_hash(self, username, password_hash):
+        """
+        Replace the password hash of an existing user
+        """
+        raise NotImplementedError
+
+    def create_library(self, username):
+        """
+        Create an empty library for username, raising UserExistsError if
+        one already exists
+        """
+        raise NotImplementedError
+
+    def create_user(self, username, password_hash):
+        """
+        Create a library for a new user and record their password hash as
+        one operation. Backends override this to do both in a single write.
+        """
+        self.create_library(username)
+        self.add_user(username, password_hash)
+
+    def open_library(self, username):
+        """
+        Return the LibraryStore for username
+        """
+        raise NotImplementedError
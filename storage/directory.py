@@ -0,0 +1,73 @@
+"""In-memory directory of usernames and their password hashes"""
+import threading
+import time
+
+
+class UserDirectory:
+    """
+    Every username and password hash, loaded with one read through the
+    load callable (which returns a dict of username to hash) and served
+    from memory until ttl seconds have passed. A lookup of an unknown
+    username reloads early, in case the user was created elsewhere since
+    the last load, and the miss is then remembered for miss_ttl seconds,
+    so looking the same name up again does not reload every user again.
+    """
+
+    def __init__(self, load, ttl=300, miss_ttl=30):
+        self.load = load
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.users = {}
+        # username to when a reload last found no such user
+        self.misses = {}
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Reload every user
+        """
+        users = self.load()
+        with self.lock:
+            self.users = users
+            self.loaded_at = time.monotonic()
+            self.misses = {username: missed_at
+                           for username, missed_at in self.misses.items()
+                           if self.loaded_at - missed_at <= self.miss_ttl}
+
+    def _stale(self):
+        return (self.loaded_at is None
+                or time.monotonic() - self.loaded_at > self.ttl)
+
+    def get(self, username):
+        """
+        Return the password hash for username, or None if there is no such
+        user
+        """
+        if self._stale():
+            self.refresh()
+        elif username not in self.users:
+            now = time.monotonic()
+            missed_at = self.misses.get(username)
+            # only reload for a miss if the last load is not brand new and
+            # the name was not missed recently
+            recent = (missed_at is not None
+                      and now - missed_at <= self.miss_ttl)
+            if now - self.loaded_at > 1 and not recent:
+                self.refresh()
+        password_hash = self.users.get(username)
+        if password_hash is None:
+            with self.lock:
+                self.misses[username] = self.loaded_at
+        return password_hash
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def set(self, username, password_hash):
+        """
+        Record a user that has just been written to storage
+        """
+        with self.lock:
+            self.users[username] = password_hash
+            self.misses.pop(username, None)
@@ -0,0 +1,692 @@
+"""Google Sheets storage backend"""
+import random
+import zlib
+
+import gspread
+import requests
+from google.auth.exceptions import TransportError
+from google.oauth2.service_account import Credentials
+from gspread.exceptions import APIError
+from gspread.utils import absolute_range_name, rowcol_to_a1
+
+from storage.base import (
+    HEADERS, Storage, LibraryStore, StorageError, UserExistsError,
+    row_checksum
+)
+from storage.directory import UserDirectory
+import metrics
+from quota import (
+    call_with_retry, RETRY_STATUSES, WRITE_RETRY_STATUSES, SHEETS_READS,
+    SHEETS_WRITES
+)
+
+# the header row of a library: the book columns, then the checksum of each
+# book, then the revision token of the library in the next cell along
+COLUMNS = HEADERS + ['Checksum']
+CHECKSUM = len(HEADERS)
+REVISION = len(COLUMNS)
+
+# what a request to the Sheets API raises when it fails: an error
+# response, or no response at all when the connection drops
+API_ERRORS = (APIError, requests.exceptions.RequestException, TransportError)
+
+# define scope
+SCOPE = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.file",
+    "https://www.googleapis.com/auth/drive"
+    ]
+
+
+class QuotaClient(gspread.Client):
+    """
+    A gspread client that takes every request through the Sheets read or
+    write token bucket and retries rate limited and failed requests
+    """
+
+    # how to wait before a retry and where to count it, time.sleep and
+    # quota.STATS unless replaced, as benchmarks/check_quota.py does
+    sleep = None
+    stats = None
+
+    def request(self, method, endpoint, *args, **kwargs):
+        if method.lower() == 'get':
+            bucket, statuses = SHEETS_READS, RETRY_STATUSES
+        else:
+            bucket, statuses = SHEETS_WRITES, WRITE_RETRY_STATUSES
+
+        def should_retry(error):
+            return (isinstance(error, APIError)
+                    and error.response.status_code in statuses)
+
+        def send():
+            return gspread.Client.request(
+                self, method, endpoint, *args, **kwargs)
+
+        name = metrics.endpoint_name(method, endpoint) if metrics.ENABLED \
+            else None
+        try:
+            return call_with_retry(
+                lambda: metrics.call('sheets', name, send),
+                should_retry, bucket, sleep=self.sleep, stats=self.stats)
+        except (requests.exceptions.RequestException,
+                TransportError) as error:
+            raise StorageError(f"unable to reach Google Sheets: {error}") \
+                from error
+
+
+def text_data(value):
+    """
+    Return the CellData for a value, always stored as text as the RAW
+    value input option does, so that ISBNs and years read back exactly as
+    they were written rather than in the sheet's number format
+    """
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+
+def row_data(values):
+    """
+    Return the RowData for a list of values
+    """
+    return {'values': [text_data(value) for value in values]}
+
+
+def book_data(book):
+    """
+    Return the RowData for a book followed by its checksum
+    """
+    data = row_data(book)
+    data['values'].append(text_data(row_checksum(book)))
+    return data
+
+
+def contiguous_ranges(indexes):
+    """
+    Return the sorted (start, stop) ranges covering a set of indexes, with
+    adjacent indexes merged into one range
+    """
+    ranges = []
+    for index in sorted(set(indexes)):
+        if ranges and ranges[-1][1] == index:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return [tuple(span) for span in ranges]
+
+
+class SheetsBatch:
+    """
+    Collects the writes of one logical operation and sends them to the
+    spreadsheet as a single batch_update round trip. The Sheets API applies
+    a batch atomically, so either every write succeeds or none do.
+
+    Use it as a context manager to commit when the block finishes:
+
+        with SheetsBatch(spreadsheet) as batch:
+            batch.update_row(sheet_id, 4, ['Title', 'Author', '1999', ''])
+    """
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self.requests = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def add_sheet(self, title, rows=100, cols=20):
+        """
+        Add a worksheet and return the sheet id it will be created with
+        """
+        sheet_id = random.randint(1, 2 ** 31 - 1)
+        self.requests.append({'addSheet': {'properties': {
+            'sheetId': sheet_id,
+            'title': title,
+            'gridProperties': {'rowCount': rows, 'columnCount': cols}
+        }}})
+        return sheet_id
+
+    def update_row(self, sheet_id, row, values):
+        """
+        Overwrite a row (0-based) starting from the first column
+        """
+        self.requests.append({'updateCells': {
+            'rows': [row_data(values)],
+            'fields': 'userEnteredValue',
+            'start': {'sheetId': sheet_id, 'rowIndex': row,
+                      'columnIndex': 0}
+        }})
+
+    def update_book(self, sheet_id, row, book):
+        """
+        Overwrite a row (0-based) with a book and its checksum
+        """
+        self.requests.append({'updateCells': {
+            'rows': [book_data(book)],
+            'fields': 'userEnteredValue',
+            'start': {'sheetId': sheet_id, 'rowIndex': row,
+                      'columnIndex': 0}
+        }})
+
+    def update_checksums(self, sheet_id, row, books):
+        """
+        Write the checksum of each book into the checksum column, starting
+        from a row (0-based)
+        """
+        self.requests.append({'updateCells': {
+            'rows': [{'values': [text_data(row_checksum(book))]}
+                     for book in books],
+            'fields': 'userEnteredValue',
+            'start': {'sheetId': sheet_id, 'rowIndex': row,
+                      'columnIndex': CHECKSUM}
+        }})
+
+    def new_revision(self, sheet_id):
+        """
+        Give a library worksheet a new random revision token and return it
+        """
+        revision = f'{random.getrandbits(64):016x}'
+        self.requests.append({'updateCells': {
+            'rows': [{'values': [text_data(revision)]}],
+            'fields': 'userEnteredValue',
+            'start': {'sheetId': sheet_id, 'rowIndex': 0,
+                      'columnIndex': REVISION}
+        }})
+        return revision
+
+    def append_columns(self, sheet_id, count):
+        """
+        Add count empty columns to the right of a worksheet
+        """
+        self.requests.append({'appendDimension': {
+            'sheetId': sheet_id,
+            'dimension': 'COLUMNS',
+            'length': count
+        }})
+
+    def rename_sheet(self, sheet_id, title):
+        """
+        Change the title of a worksheet
+        """
+        self.requests.append({'updateSheetProperties': {
+            'properties': {'sheetId': sheet_id, 'title': title},
+            'fields': 'title'
+        }})
+
+    def delete_sheet(self, sheet_id):
+        """
+        Delete a worksheet
+        """
+        self.requests.append({'deleteSheet': {'sheetId': sheet_id}})
+
+    def append_row(self, sheet_id, values):
+        """
+        Append a row after the last row with data
+        """
+        self.requests.append({'appendCells': {
+            'sheetId': sheet_id,
+            'rows': [row_data(values)],
+            'fields': 'userEnteredValue'
+        }})
+
+    def append_books(self, sheet_id, books):
+        """
+        Append books with their checksums after the last row with data
+        """
+        self.requests.append({'appendCells': {
+            'sheetId': sheet_id,
+            'rows': [book_data(book) for book in books],
+            'fields': 'userEnteredValue'
+        }})
+
+    def delete_rows(self, sheet_id, start, stop):
+        """
+        Delete rows start to stop - 1 (0-based), moving the rows below up
+        """
+        self.requests.append({'deleteDimension': {'range': {
+            'sheetId': sheet_id,
+            'dimension': 'ROWS',
+            'startIndex': start,
+            'endIndex': stop
+        }}})
+
+    def commit(self):
+        """
+        Send every collected write in one request
+        """
+        if not self.requests:
+            return None
+        requests, self.requests = self.requests, []
+        try:
+            return self.spreadsheet.batch_update({'requests': requests})
+        except API_ERRORS as error:
+            raise StorageError(error) from error
+
+
+class SheetsLibrary(LibraryStore):
+    """
+    A user's library stored as a worksheet with a header row.
+
+    Every book is written with its row_checksum in the column after the
+    books, and every write gives the worksheet a new random revision token
+    in the header row, so a cached copy can check the one cell to see if
+    anything has changed and then the checksums to see which books have.
+    Changes made by hand in the spreadsheet do not update either, and are
+    only seen when the library is read in full.
+    """
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self.expected = None
+
+    def get_rows(self):
+        return self.get_revision_and_rows()[1]
+
+    def get_revision_and_rows(self):
+        # the revision token is in the header row read with the books
+        try:
+            values = self.worksheet.get_all_values()
+        except API_ERRORS as error:
+            raise StorageError(error) from error
+        if not values or values[0][:len(COLUMNS)] != COLUMNS:
+            return self.migrate(values[1:]), values[1:]
+        header = values[0]
+        return (header[REVISION] if len(header) > REVISION else '',
+                values[1:])
+
+    def migrate(self, rows=()):
+        """
+        Bring the header row up to date with COLUMNS, adding columns if the
+        sheet is too narrow, and write the checksums of the books. Sheets
+        created before the ISBN column existed get an empty ISBN column
+        this way, and sheets created before checksums were kept get them.
+        Returns the new revision.
+        """
+        with SheetsBatch(self.worksheet.spreadsheet) as batch:
+            if self.worksheet.col_count <= REVISION:
+                batch.append_columns(
+                    self.worksheet.id,
+                    REVISION + 1 - self.worksheet.col_count)
+            batch.update_row(self.worksheet.id, 0, COLUMNS)
+            if rows:
+                batch.update_checksums(self.worksheet.id, 1, rows)
+            return batch.new_revision(self.worksheet.id)
+
+    def _batch_get(self, ranges):
+        """
+        Return the values of several A1 ranges of the worksheet, read in
+        one request
+        """
+        try:
+            response = self.worksheet.spreadsheet.values_batch_get(
+                [absolute_range_name(self.worksheet.title, cells)
+                 for cells in ranges])
+        except API_ERRORS as error:
+            raise StorageError(error) from error
+        return [value_range.get('values', [])
+                for value_range in response['valueRanges']]
+
+    def count_rows(self):
+        # the grid size from the sheet metadata, less the header row. New
+        # sheets only grow as rows are appended so this is exact for them;
+        # older sheets were created with blank rows and over-estimate.
+        try:
+            metadata = self.worksheet.spreadsheet.fetch_sheet_metadata({
+                'ranges': absolute_range_name(self.worksheet.title),
+                'fields': 'sheets.properties.gridProperties.rowCount'
+            })
+        except API_ERRORS as error:
+            raise StorageError(error) from error
+        properties = metadata['sheets'][0]['properties']
+        return max(0, properties['gridProperties']['rowCount'] - 1)
+
+    @staticmethod
+    def _books_range(start, stop):
+        """
+        Return the A1 range of the books at positions start to stop - 1
+        """
+        # book positions are 0-based and the first row holds the headers
+        return (f'{rowcol_to_a1(start + 2, 1)}:'
+                f'{rowcol_to_a1(stop + 1, len(HEADERS))}')
+
+    def get_range(self, start, stop):
+        try:
+            return list(self.worksheet.get(self._books_range(start, stop)))
+        except API_ERRORS as error:
+            raise StorageError(error) from error
+
+    def get_ranges(self, ranges):
+        if not ranges:
+            return []
+        return self._batch_get([self._books_range(start, stop)
+                                for start, stop in ranges])
+
+    def get_revision(self):
+        cell = rowcol_to_a1(1, REVISION + 1)
+        try:
+            values = self.worksheet.get(cell)
+        except API_ERRORS as error:
+            raise StorageError(error) from error
+        return values[0][0] if values and values[0] else ''
+
+    def get_checksums(self):
+        column = rowcol_to_a1(1, CHECKSUM + 1).rstrip('1')
+        revision, checksums = self._batch_get([
+            rowcol_to_a1(1, REVISION + 1), f'{column}2:{column}'])
+        revision = revision[0][0] if revision and revision[0] else ''
+        return revision, [row[0] if row else '' for row in checksums]
+
+    def expect_revision(self, revision):
+        self.expected = revision
+
+    def _write(self):
+        """
+        Return a batch for a write to the library, which gives it a new
+        revision when it commits, and that revision if the library is
+        still at the expected revision, or else None. Sheets cannot make a
+        write depend on a cell, so a write made elsewhere between the check
+        and this one is missed until the library next changes.
+        """
+        expected, self.expected = self.expected, None
+        current = expected is not None and self.get_revision() == expected
+        batch = SheetsBatch(self.worksheet.spreadsheet)
+        revision = batch.new_revision(self.worksheet.id)
+        return batch, revision if current else None
+
+    def append_row(self, row):
+        return self.append_rows([row])
+
+    def append_rows(self, rows):
+        batch, revision = self._write()
+        with batch:
+            batch.append_books(self.worksheet.id, rows)
+        return revision
+
+    def delete_row(self, index):
+        # sheet rows are 0-based here and the first row holds the headers
+        batch, revision = self._write()
+        with batch:
+            batch.delete_rows(self.worksheet.id, index + 1, index + 2)
+        return revision
+
+    def delete_rows(self, indexes):
+        # contiguous books are deleted as one range, and the ranges are
+        # deleted from the bottom up so the earlier ones do not move
+        batch, revision = self._write()
+        with batch:
+            for start, stop in reversed(contiguous_ranges(indexes)):
+                batch.delete_rows(self.worksheet.id, start + 1, stop + 1)
+        return revision
+
+    def update_row(self, index, row):
+        # 0-based row index, skipping the headers
+        batch, revision = self._write()
+        with batch:
+            batch.update_book(self.worksheet.id, index + 1, row)
+        return revision
+
+
+def shard_for(username, shards):
+    """
+    Pick the shard a new user's library goes in by a stable hash of their
+    username
+    """
+    return shards[zlib.crc32(username.encode('utf-8')) % len(shards)]
+
+
+class SheetsStorage(Storage):
+    """
+    Users kept in the 'users' worksheet of a spreadsheet, with one
+    worksheet per user holding their library.
+
+    Libraries can be spread over several shard spreadsheets, given by name,
+    so the number of users is not limited by what one spreadsheet holds.
+    New libraries go in a shard picked by hashing the username, and the
+    shard of each library is recorded in the third column of the users
+    worksheet. Libraries with no shard recorded are in the main
+    spreadsheet, as every library was before sharding.
+    """
+
+    def __init__(self, spreadsheet, shards=()):
+        self.spreadsheet = spreadsheet
+        self.shards = list(shards)
+        self._shard_spreadsheets = {}
+        self._worksheets = {}
+        self._user_rows = {}
+        self._routes = {}
+        self.directory = UserDirectory(self._load_users)
+
+    @classmethod
+    def connect(cls, creds_file, spreadsheet_name, shards=()):
+        """
+        Authorize with a service account and open the named spreadsheet,
+        with libraries sharded over the named shard spreadsheets
+        """
+        # add credentials to the account
+        creds = Credentials.from_service_account_file(creds_file)
+        scoped_creds = creds.with_scopes(SCOPE)
+
+        # authorize the clientsheet and get the instance of the Spreadsheet
+        client = gspread.authorize(scoped_creds, client_factory=QuotaClient)
+        return cls(client.open(spreadsheet_name), shards)
+
+    def shard_spreadsheet(self, shard):
+        """
+        Return the spreadsheet of a shard, opening it the first time. The
+        empty shard is the main spreadsheet.
+        """
+        if not shard:
+            return self.spreadsheet
+        if shard not in self._shard_spreadsheets:
+            try:
+                self._shard_spreadsheets[shard] = \
+                    self.spreadsheet.client.open(shard)
+            except (*API_ERRORS, gspread.SpreadsheetNotFound) as error:
+                raise StorageError(
+                    f"unable to open shard '{shard}': {error}") from error
+        return self._shard_spreadsheets[shard]
+
+    def _worksheets_of(self, spreadsheet, refresh=False):
+        """
+        Return the worksheets of a spreadsheet by title from the cached
+        spreadsheet metadata, fetching it if it is not cached or refresh
+        is set
+        """
+        if refresh or spreadsheet.id not in self._worksheets:
+            try:
+                self._worksheets[spreadsheet.id] = {
+                    worksheet.title: worksheet
+                    for worksheet in spreadsheet.worksheets()}
+            except API_ERRORS as error:
+                raise StorageError(error) from error
+        return self._worksheets[spreadsheet.id]
+
+    def worksheet(self, title, spreadsheet=None):
+        """
+        Return a worksheet of the main spreadsheet, or the one given, by
+        title from the cached spreadsheet metadata, fetching the metadata
+        again only if the title is not in it
+        """
+        spreadsheet = spreadsheet or self.spreadsheet
+        worksheets = self._worksheets_of(spreadsheet)
+        if title not in worksheets:
+            worksheets = self._worksheets_of(spreadsheet, refresh=True)
+        try:
+            return worksheets[title]
+        except KeyError:
+            raise StorageError(f"no worksheet named '{title}'") from None
+
+    def _load_users(self):
+        """
+        Read every username, password hash and shard with one ranged read
+        """
+        try:
+            values = self.spreadsheet.values_get('users!A:C').get('values', [])
+        except API_ERRORS as error:
+            raise StorageError(error) from error
+        self._user_rows = {row[0]: number
+                           for number, row in enumerate(values, 1) if row}
+        self._routes = {row[0]: row[2] for row in values
+                        if len(row) >= 3 and row[2]}
+        return {row[0]: row[1] for row in values if len(row) >= 2}
+
+    def route(self, username):
+        """
+        Return the shard holding a user's library, '' for the main
+        spreadsheet
+        """
+        self.directory.get(username)
+        return self._routes.get(username, '')
+
+    def get_password_hash(self, username):
+        return self.directory.get(username)
+
+    def add_user(self, username, password_hash):
+        try:
+            self.worksheet('users').append_row(
+                [username, password_hash, self._routes.get(username, '')])
+        except API_ERRORS as error:
+            raise StorageError(error) from error
+        self.directory.set(username, password_hash)
+
+    def _update_user_cell(self, username, column, value):
+        """
+        Overwrite one cell of a user's row in the users worksheet
+        """
+        if username not in self._user_rows:
+            self.directory.refresh()
+        try:
+            self.spreadsheet.values_update(
+                f'users!{column}{self._user_rows[username]}',
+                params={'valueInputOption': 'RAW'},
+                body={'values': [[value]]})
+        except KeyError:
+            raise StorageError(f"no user named '{username}'") from None
+        except API_ERRORS as error:
+            raise StorageError(error) from error
+
+    def set_password_hash(self, username, password_hash):
+        self._update_user_cell(username, 'B', password_hash)
+        self.directory.set(username, password_hash)
+
+    def _new_shard(self, username):
+        """
+        Return the shard a new library for username goes in
+        """
+        return shard_for(username, self.shards) if self.shards else ''
+
+    def create_library(self, username):
+        shard = self._new_shard(username)
+        batch = SheetsBatch(self.shard_spreadsheet(shard))
+        # a single header row, so the grid grows exactly with the books
+        sheet_id = batch.add_sheet(username, rows=1)
+        batch.update_row(sheet_id, 0, COLUMNS)
+        self._commit_new_sheet(batch)
+        self._routes[username] = shard
+
+    def create_user(self, username, password_hash):
+        shard = self._new_shard(username)
+        if shard:
+            # the library and the users row are in different spreadsheets
+            # so cannot share a batch. The library goes first; one left by
+            # an earlier attempt that failed to add the user is taken over.
+            try:
+                self.create_library(username)
+            except UserExistsError:
+                if username in self.directory:
+                    raise
+                self._routes[username] = shard
+            self.add_user(username, password_hash)
+            return
+        batch = SheetsBatch(self.spreadsheet)
+        # a single header row, so the grid grows exactly with the books
+        sheet_id = batch.add_sheet(username, rows=1)
+        batch.update_row(sheet_id, 0, COLUMNS)
+        batch.append_row(self.worksheet('users').id,
+                         [username, password_hash])
+        self._commit_new_sheet(batch)
+        self.directory.set(username, password_hash)
+
+    def _commit_new_sheet(self, batch):
+        """
+        Commit a batch that adds a worksheet, reporting a name clash as
+        UserExistsError, and remember the new worksheet
+        """
+        try:
+            response = batch.commit()
+        except StorageError as error:
+            if 'already exists' in str(error):
+                raise UserExistsError(
+                    "a sheet with that name already exists") from error
+            raise
+        worksheets = self._worksheets.get(batch.spreadsheet.id)
+        if worksheets is not None:
+            properties = response['replies'][0]['addSheet']['properties']
+            worksheets[properties['title']] = gspread.Worksheet(
+                batch.spreadsheet, properties)
+
+    def open_library(self, username):
+        shard = self.route(username)
+        try:
+            worksheet = self.worksheet(username,
+                                       self.shard_spreadsheet(shard))
+        except StorageError:
+            # the library may have been moved since the users were loaded
+            self.directory.refresh()
+            if self.route(username) == shard:
+                raise
+            worksheet = self.worksheet(
+                username, self.shard_spreadsheet(self.route(username)))
+        return SheetsLibrary(worksheet)
+
+    def move_library(self, username, shard):
+        """
+        Move a user's library to a shard ('' for the main spreadsheet). The
+        worksheet is copied first, then the route is changed and only then
+        is the old worksheet deleted, so a move that stops part way can
+        simply be run again; copies left by one are deleted first.
+
+        Moves are meant to be made while nobody is using the library, as a
+        session that has it open keeps writing to the old worksheet. The
+        library's revision is checked after the copy and again after the
+        route is changed, and if it has changed the move is undone and
+        StorageError raised, so no write is lost to the move.
+        """
+        library = self.open_library(username)
+        source = library.worksheet
+        target = self.shard_spreadsheet(shard)
+        if source.spreadsheet.id == target.id:
+            return
+        current = self.route(username)
+        revision = library.get_revision()
+        worksheets = self._worksheets_of(target, refresh=True)
+        with SheetsBatch(target) as batch:
+            # copies left by a move that stopped before changing the route
+            for title in (username, f'Copy of {username}'):
+                if title in worksheets:
+                    batch.delete_sheet(worksheets[title].id)
+        try:
+            properties = source.copy_to(target.id)
+        except API_ERRORS as error:
+            raise StorageError(error) from error
+        with SheetsBatch(target) as batch:
+            batch.rename_sheet(properties['sheetId'], username)
+        if library.get_revision() == revision:
+            self._update_user_cell(username, 'C', shard)
+            self._routes[username] = shard
+            if library.get_revision() == revision:
+                with SheetsBatch(source.spreadsheet) as batch:
+                    batch.delete_sheet(source.id)
+                self._worksheets_of(target, refresh=True)
+                self._worksheets_of(source.spreadsheet, refresh=True)
+                return
+            self._update_user_cell(username, 'C', current)
+            self._routes[username] = current
+        with SheetsBatch(target) as batch:
+            batch.delete_sheet(properties['sheetId'])
+        self._worksheets_of(target, refresh=True)
+        raise StorageError("the library changed while it was being moved, "
+                           "move it again once it is not in use")
@@ -0,0 +1,241 @@
+"""Local SQLite storage backend"""
+import functools
+import sqlite3
+import threading
+
+from storage.base import Storage, LibraryStore, StorageError, UserExistsError
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS libraries (
+    username TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL REFERENCES libraries(username),
+    title TEXT NOT NULL DEFAULT '',
+    author TEXT NOT NULL DEFAULT '',
+    year TEXT NOT NULL DEFAULT '',
+    genre TEXT NOT NULL DEFAULT '',
+    isbn TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS books_title ON books (username, title);
+CREATE INDEX IF NOT EXISTS books_author ON books (username, author);
+CREATE INDEX IF NOT EXISTS books_genre ON books (username, genre);
+CREATE INDEX IF NOT EXISTS books_isbn ON books (username, isbn);
+"""
+
+# book columns in HEADERS order
+COLUMNS = ['title', 'author', 'year', 'genre', 'isbn']
+
+
+def locked(method):
+    """
+    Run a method holding the connection's lock, so that statements and
+    transactions from different threads sharing it do not interleave
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class SqliteLibrary(LibraryStore):
+    """
+    A user's books stored as rows of the books table. Positions are
+    mapped to row ids in insertion order, the same order a sheet keeps.
+    """
+
+    def __init__(self, connection, username, lock):
+        self.connection = connection
+        self.username = username
+        self.lock = lock
+        self.ids = []
+
+    @locked
+    def get_rows(self):
+        try:
+            cursor = self.connection.execute(
+                f"SELECT id, {', '.join(COLUMNS)} FROM books "
+                "WHERE username = ? ORDER BY id", (self.username,))
+            rows = cursor.fetchall()
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+        self.ids = [row[0] for row in rows]
+        return [list(row[1:]) for row in rows]
+
+    @locked
+    def count_rows(self):
+        try:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM books WHERE username = ?",
+                (self.username,)).fetchone()[0]
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+
+    @locked
+    def get_range(self, start, stop):
+        try:
+            cursor = self.connection.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM books "
+                "WHERE username = ? ORDER BY id LIMIT ? OFFSET ?",
+                (self.username, stop - start, start))
+            return [list(row) for row in cursor.fetchall()]
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+
+    @locked
+    def append_row(self, row):
+        try:
+            with self.connection:
+                cursor = self.connection.execute(
+                    f"INSERT INTO books (username, {', '.join(COLUMNS)}) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [self.username] + [str(value) for value in row[:5]])
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+        self.ids.append(cursor.lastrowid)
+
+    @locked
+    def append_rows(self, rows):
+        new_ids = []
+        try:
+            with self.connection:
+                for row in rows:
+                    cursor = self.connection.execute(
+                        f"INSERT INTO books (username, {', '.join(COLUMNS)}) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        [self.username] + [str(value) for value in row[:5]])
+                    new_ids.append(cursor.lastrowid)
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+        self.ids.extend(new_ids)
+
+    @locked
+    def delete_row(self, index):
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "DELETE FROM books WHERE id = ?", (self.ids[index],))
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+        del self.ids[index]
+
+    @locked
+    def delete_rows(self, indexes):
+        indexes = sorted(set(indexes))
+        try:
+            with self.connection:
+                self.connection.executemany(
+                    "DELETE FROM books WHERE id = ?",
+                    [(self.ids[index],) for index in indexes])
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+        for index in reversed(indexes):
+            del self.ids[index]
+
+    @locked
+    def update_row(self, index, row):
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE books SET "
+                    f"{', '.join(col + ' = ?' for col in COLUMNS)} "
+                    "WHERE id = ?",
+                    [str(value) for value in row[:5]] + [self.ids[index]])
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+
+
+class SqliteStorage(Storage):
+    """
+    Users and libraries kept in a local SQLite database file
+    """
+
+    def __init__(self, path):
+        try:
+            # the storage may be opened in a background thread and used
+            # from another
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.lock = threading.RLock()
+            self.connection.executescript(SCHEMA)
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+
+    @locked
+    def get_password_hash(self, username):
+        try:
+            row = self.connection.execute(
+                "SELECT password_hash FROM users WHERE username = ?",
+                (username,)).fetchone()
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+        return row[0] if row else None
+
+    @locked
+    def add_user(self, username, password_hash):
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT INTO users (username, password_hash) "
+                    "VALUES (?, ?)", (username, password_hash))
+        except sqlite3.IntegrityError as error:
+            raise UserExistsError("a user with that name already exists") \
+                from error
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+
+    @locked
+    def set_password_hash(self, username, password_hash):
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE users SET password_hash = ? WHERE username = ?",
+                    (password_hash, username))
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+
+    @locked
+    def create_library(self, username):
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT INTO libraries (username) VALUES (?)",
+                    (username,))
+        except sqlite3.IntegrityError as error:
+            raise UserExistsError(
+                "a library with that name already exists") from error
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+
+    @locked
+    def create_user(self, username, password_hash):
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT INTO libraries (username) VALUES (?)",
+                    (username,))
+                self.connection.execute(
+                    "INSERT INTO users (username, password_hash) "
+                    "VALUES (?, ?)", (username, password_hash))
+        except sqlite3.IntegrityError as error:
+            raise UserExistsError("a user with that name already exists") \
+                from error
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+
+    @locked
+    def open_library(self, username):
+        try:
+            row = self.connection.execute(
+                "SELECT 1 FROM libraries WHERE username = ?",
+                (username,)).fetchone()
+        except sqlite3.Error as error:
+            raise StorageError(error) from error
+        if not row:
+            raise StorageError(f"no library for user '{username}'")
+        return SqliteLibrary(self.connection, username, self.lock)
@@ -0,0 +1,185 @@
+"""
+Export a user's library to a file, or import one into it.
+
+Books are streamed between the storage backend and the file a chunk at a
+time: an export reads the library in ranges of --chunk-size books and
+writes each range out before reading the next, and an import reads that
+many books from the file and appends them to the library in one write
+before reading more. Only one chunk is ever held in memory, so libraries
+of any size can be backed up or moved between backends.
+
+    python transfer.py export alice alice.csv
+    python transfer.py import alice alice.jsonl
+
+The format is picked from the file extension: CSV with a header row, or
+JSON Lines with one object per book keyed by the library headers. The
+storage backend is the one set by BOOKWORM_STORAGE, as for run.py. Books
+are imported straight into the backend, so with BOOKWORM_OFFLINE set they
+bypass the offline journal.
+"""
+import argparse
+import csv
+import json
+from itertools import islice
+
+from storage import HEADERS, StorageError, open_storage
+
+# books read from or written to the storage backend at a time
+CHUNK_SIZE = 2000
+
+FORMATS = ('csv', 'jsonl')
+
+
+def _normalise(row):
+    """
+    Pad or trim a row to exactly one string per header
+    """
+    row = [str(value) for value in row[:len(HEADERS)]]
+    return row + [''] * (len(HEADERS) - len(row))
+
+
+def chunks(rows, size):
+    """
+    Yield lists of up to size rows from an iterable of rows
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_library(store, chunk_size=CHUNK_SIZE):
+    """
+    Yield every book in a library in order, reading a range of chunk_size
+    books at a time. A short range means the end has been reached, as the
+    backend's count of books may be an over-estimate.
+    """
+    start = 0
+    while True:
+        rows = store.get_range(start, start + chunk_size)
+        for row in rows:
+            yield _normalise(row)
+        if len(rows) < chunk_size:
+            return
+        start += chunk_size
+
+
+def write_csv(rows, file):
+    """
+    Write rows to a CSV file after a header row and return how many there
+    were
+    """
+    writer = csv.writer(file)
+    writer.writerow(HEADERS)
+    count = 0
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+    return count
+
+
+def write_jsonl(rows, file):
+    """
+    Write rows to a JSON Lines file as objects keyed by the headers and
+    return how many there were
+    """
+    count = 0
+    for count, row in enumerate(rows, 1):
+        file.write(json.dumps(dict(zip(HEADERS, row))) + '\n')
+    return count
+
+
+def read_csv(file):
+    """
+    Yield the books in a CSV file, skipping blank lines and a header row
+    """
+    for row in csv.reader(file):
+        if any(value.strip() for value in row) and row != HEADERS:
+            yield _normalise(row)
+
+
+def read_jsonl(file):
+    """
+    Yield the books in a JSON Lines file of objects keyed by the headers,
+    skipping blank lines
+    """
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            book = json.loads(line)
+        except ValueError:
+            book = None
+        if not isinstance(book, dict):
+            raise ValueError(f"line {number} is not a JSON object")
+        yield _normalise([book.get(header, '') for header in HEADERS])
+
+
+def file_format(path):
+    """
+    Return the format of a file from its extension
+    """
+    extension = path.rpartition('.')[2].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"'{path}' is not a .csv or .jsonl file")
+    return extension
+
+
+def export_library(store, path, chunk_size=CHUNK_SIZE):
+    """
+    Write every book in a library to a file and return how many there were
+    """
+    write = write_csv if file_format(path) == 'csv' else write_jsonl
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        return write(read_library(store, chunk_size), file)
+
+
+def import_library(store, path, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Append every book in a file to a library, chunk_size books per write,
+    and return how many there were. progress, if given, is called with the
+    number of books imported so far after each write.
+    """
+    read = read_csv if file_format(path) == 'csv' else read_jsonl
+    count = 0
+    with open(path, newline='', encoding='utf-8') as file:
+        for chunk in chunks(read(file), chunk_size):
+            store.append_rows(chunk)
+            count += len(chunk)
+            if progress:
+                progress(count)
+    return count
+
+
+def main():
+    """
+    Parse the command line and export or import the library
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('username')
+    parser.add_argument('path', help="a .csv or .jsonl file")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help=f"books per read or write (default "
+                             f"{CHUNK_SIZE})")
+    args = parser.parse_args()
+
+    try:
+        file_format(args.path)
+        store = open_storage().open_library(args.username)
+        if args.command == 'export':
+            count = export_library(store, args.path, args.chunk_size)
+            print(f"{count} books exported to {args.path}")
+        else:
+            count = import_library(
+                store, args.path, args.chunk_size,
+                progress=lambda done: print(f"\r{done} books imported",
+                                            end="", flush=True))
+            print(f"\r{count} books imported from {args.path}")
+    except (StorageError, OSError, ValueError) as error:
+        parser.exit(1, f"{parser.prog}: error: {error}\n")
+
+
+if __name__ == '__main__':
+    main()
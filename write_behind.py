@@ -0,0 +1,328 @@
+"""
+Libraries whose writes are sent to the storage backend in the background.
+
+Each change is put on a bounded queue and the menus carry on straight
+away, while a single writer thread applies the queued changes to the real
+storage backend in order. Books appended one after another while earlier
+writes are still in flight go out together in one append_rows. If a write
+fails, it and every change queued after it are dropped, as their positions
+no longer match the backend, and the failure is kept for the menus to
+report along with what was lost; the library is then loaded again from
+the backend.
+
+Used whenever BOOKWORM_OFFLINE is not set. Offline libraries already
+write behind through their journal.
+"""
+import collections
+import threading
+
+import metrics
+from storage import LibraryStore, StorageError
+
+# most changes waiting to be written before new ones wait for room
+MAX_PENDING = 1000
+
+# most books written in one append_rows when appends are coalesced
+MAX_APPEND = 500
+
+# most seconds a read waits for the queue to be written, or a change for
+# room in the queue, before giving up with a StorageError
+WAIT_TIMEOUT = 120
+
+# the revision reported while the backend is as this store's own writes
+# left it, which is what writes return as they are queued
+OWN_REVISION = 'own-writes'
+
+
+def _call(func, *args):
+    """
+    Call func with args, for running with the context of another action
+    """
+    return func(*args)
+
+
+class WriteBehindLibrary(LibraryStore):
+    """
+    A LibraryStore that queues writes for a Writer to apply to the remote
+    store. Reads wait for the queue to empty first, so they always see
+    every change made before them.
+    """
+
+    def __init__(self, remote, max_pending=MAX_PENDING):
+        self.remote = remote
+        self.max_pending = max_pending
+        self.queue = collections.deque()
+        self.in_flight = 0
+        self.failures = []
+        self.expected = None
+        self.written = None
+        self.stopped = False
+        self.changed = threading.Condition()
+
+    def _enqueue(self, op, *args):
+        """
+        Queue a change, waiting while the queue is full
+        """
+        with self.changed:
+            if self.failures:
+                raise StorageError(
+                    "earlier changes could not be saved: "
+                    f"{self.failures[-1][0]}")
+            if not self.changed.wait_for(
+                    lambda: len(self.queue) < self.max_pending,
+                    WAIT_TIMEOUT):
+                raise StorageError("too many changes are waiting to be "
+                                   "saved, please try again later")
+            self.queue.append(
+                (op, args, metrics.carry(_call), self.expected))
+            self.changed.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued change has been written or dropped, at
+        most timeout seconds. Returns True if none are left.
+        """
+        with self.changed:
+            return self.changed.wait_for(
+                lambda: not self.queue and not self.in_flight, timeout)
+
+    def _settle(self):
+        """
+        Wait for the queue to be written before a read, raising StorageError
+        if it takes longer than WAIT_TIMEOUT
+        """
+        if not self.flush(WAIT_TIMEOUT):
+            raise StorageError("your changes are still being saved, "
+                               "please try again later")
+
+    @property
+    def pending_count(self):
+        """
+        Number of changes waiting to be written
+        """
+        with self.changed:
+            return len(self.queue) + self.in_flight
+
+    def _take(self):
+        """
+        Wait for the next change and take it off the queue, together with
+        the appends right behind it if it is an append. Returns None once
+        stopped with nothing left to write.
+        """
+        with self.changed:
+            self.changed.wait_for(lambda: self.queue or self.stopped)
+            if not self.queue:
+                return None
+            op, args, run, expected = self.queue.popleft()
+            taken = 1
+            if op == 'append':
+                rows = list(args[0])
+                while (self.queue and self.queue[0][0] == 'append'
+                       and len(rows) + len(self.queue[0][1][0])
+                       <= MAX_APPEND):
+                    rows.extend(self.queue.popleft()[1][0])
+                    taken += 1
+                args = (rows,)
+            self.in_flight = taken
+            self.changed.notify_all()
+            return op, args, run, expected
+
+    def write_next(self):
+        """
+        Write the next change, or appends, to the remote store. Returns
+        False once stopped with nothing left to write.
+        """
+        change = self._take()
+        if change is None:
+            return False
+        op, args, run, expected = change
+        if expected == OWN_REVISION:
+            # the cache is as this store's writes left the backend, so the
+            # backend should still be at the revision the last one gave it
+            expected = self.written
+        try:
+            self.remote.expect_revision(expected)
+            if op == 'append':
+                written = run(self.remote.append_rows, *args)
+            elif op == 'delete':
+                written = run(self.remote.delete_row, *args)
+            elif op == 'delete_rows':
+                written = run(self.remote.delete_rows, *args)
+            else:
+                written = run(self.remote.update_row, *args)
+        # whatever went wrong, the write and those queued behind it are lost
+        # and reported, and the writer carries on with new changes
+        except Exception as error:  # pylint: disable=broad-except
+            with self.changed:
+                lost = [(op, args)] + [(queued[0], queued[1])
+                                       for queued in self.queue]
+                self.failures.append((error, lost))
+                self.queue.clear()
+                self.in_flight = 0
+                self.changed.notify_all()
+            return True
+        with self.changed:
+            self.written = written
+            self.in_flight = 0
+            self.changed.notify_all()
+        return True
+
+    def _own(self, revision):
+        """
+        Return a revision of the remote store as OWN_REVISION if it is the
+        one the last write here gave it, which the remote store only
+        returns if nothing else had written to it since the cache was up
+        to date
+        """
+        if revision is not None and revision == self.written:
+            return OWN_REVISION
+        return revision
+
+    def take_failures(self):
+        """
+        Return (error, changes lost) for each failed write not reported
+        yet and forget them, so that new changes can be queued once the
+        library has been reloaded. The changes lost are (op, args) in the
+        order they were made, starting with the write that failed.
+        """
+        with self.changed:
+            failures, self.failures = self.failures, []
+            return failures
+
+    def get_rows(self):
+        self._settle()
+        return self.remote.get_rows()
+
+    def get_revision_and_rows(self):
+        self._settle()
+        revision, rows = self.remote.get_revision_and_rows()
+        return self._own(revision), rows
+
+    def count_rows(self):
+        self._settle()
+        return self.remote.count_rows()
+
+    def get_range(self, start, stop):
+        self._settle()
+        return self.remote.get_range(start, stop)
+
+    def get_ranges(self, ranges):
+        self._settle()
+        return self.remote.get_ranges(ranges)
+
+    def get_revision(self):
+        # the backend is behind the cache until the queue is written, so
+        # there is nothing to refresh from yet
+        if self.pending_count:
+            return None
+        return self._own(self.remote.get_revision())
+
+    def get_checksums(self):
+        if self.pending_count:
+            return None, None
+        revision, checksums = self.remote.get_checksums()
+        return self._own(revision), checksums
+
+    def expect_revision(self, revision):
+        with self.changed:
+            self.expected = revision
+
+    # the backend will be as this store's writes leave it once they are
+    # written, so a cache that was up to date can take on OWN_REVISION.
+    # Each write checks the revision the cache was at when it was queued.
+
+    def append_row(self, row):
+        self._enqueue('append', [row])
+        return OWN_REVISION
+
+    def append_rows(self, rows):
+        self._enqueue('append', list(rows))
+        return OWN_REVISION
+
+    def delete_row(self, index):
+        self._enqueue('delete', index)
+        return OWN_REVISION
+
+    def delete_rows(self, indexes):
+        self._enqueue('delete_rows', list(indexes))
+        return OWN_REVISION
+
+    def update_row(self, index, row):
+        self._enqueue('update', index, row)
+        return OWN_REVISION
+
+
+def describe_lost(changes, titles=None):
+    """
+    Return a description of each change lost after a failed write, such
+    as "add 'Dune'", so the user can make it again. titles are the titles
+    of the books in the backend before the first of the changes, which
+    are replayed on them to name the books removed; without them removed
+    books are left unnamed.
+    """
+    titles = list(titles) if titles is not None else None
+    descriptions = []
+    for op, args in changes:
+        if op == 'append':
+            for row in args[0]:
+                descriptions.append(f"add '{row[0]}'")
+                if titles is not None:
+                    titles.append(row[0])
+        elif op == 'update':
+            index, row = args
+            old = row[0]
+            if titles is not None and index < len(titles):
+                old, titles[index] = titles[index], row[0]
+            descriptions.append(f"update '{old}'" if old == row[0] else
+                                f"update '{old}' to '{row[0]}'")
+        else:
+            indexes = [args[0]] if op == 'delete' else args[0]
+            for index in sorted(indexes, reverse=True):
+                if titles is not None and index < len(titles):
+                    descriptions.append(f"remove '{titles.pop(index)}'")
+                else:
+                    descriptions.append("remove a book")
+    return descriptions
+
+
+class Writer:
+    """
+    Background thread that writes the changes queued on a
+    WriteBehindLibrary, in order
+    """
+
+    def __init__(self, library):
+        self.library = library
+        self.thread = threading.Thread(target=self._run, name='writer',
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.library.write_next():
+            pass
+
+    def notify(self):
+        """
+        The writer starts on each change as soon as it is queued, so there
+        is nothing to wake
+        """
+
+    def stop(self, timeout=10):
+        """
+        Write what is left, waiting at most timeout seconds, and stop.
+        Returns the number of changes that were not written.
+        """
+        self.library.flush(timeout)
+        with self.library.changed:
+            self.library.stopped = True
+            self.library.changed.notify_all()
+        self.thread.join(timeout)
+        return self.library.pending_count
+
+
+def open_write_behind_library(remote):
+    """
+    Wrap a user's LibraryStore in a WriteBehindLibrary and start its writer
+    """
+    library = WriteBehindLibrary(remote)
+    return library, Writer(library)